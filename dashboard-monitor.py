@@ -10,6 +10,7 @@ from my_secrets import (
     VALID_USERNAME_PASSWORD_PAIRS,
 )
 from maindash import app
+from tabs import scheduler
 from tabs.support import tab_support
 from tabs.kpi_and_catalog import tab_kpi_catalog
 from tabs.reuses import tab_reuses
@@ -19,6 +20,8 @@ from tabs.reports import tab_reports
 # from tabs.siret import tab_siret
 
 auth = dash_auth.BasicAuth(app, VALID_USERNAME_PASSWORD_PAIRS)
+# keeps the data of all tabs up to date in the background
+scheduler.start()
 
 
 # %% APP LAYOUT:
@@ -35,8 +38,11 @@ app.layout = dbc.Container(
                 ),
             ]
         ),
+        # tabs only load their content once selected
         dcc.Tabs(
-            [
+            id="tabs",
+            value="support",
+            children=[
                 tab_support,
                 tab_kpi_catalog,
                 tab_reuses,
@@ -44,7 +50,7 @@ app.layout = dbc.Container(
                 tab_hvd,
                 tab_reports,
                 # tab_siret,
-            ]
+            ],
         ),
     ]
 )
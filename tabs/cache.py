@@ -0,0 +1,458 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from tabs import http_client
+
+cache_folder = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache"
+)
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by the total size of its values."""
+
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self._size -= self._data.pop(key)[1]
+            # a value bigger than the whole cache would evict everything
+            if size > self.max_bytes:
+                return
+            self._data[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self._size -= evicted_size
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls sharing the same key into a single call,
+    whose result (or error) they all get.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, call):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            # later calls will be made again
+            with self._lock:
+                del self._calls[key]
+
+
+def write_atomically(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+class ObjectStorageCache:
+    """
+    Two-tier (memory + disk) cache of object storage files.
+    Cached files are served right away, and revalidated in the background
+    against the object's ETag once they are older than `revalidate_after` seconds.
+    """
+
+    def __init__(
+        self,
+        max_bytes=200 * 1024**2,
+        revalidate_after=60,
+        folder=os.path.join(cache_folder, "objects"),
+    ):
+        self.memory = LRUCache(max_bytes, sizeof=lambda entry: len(entry["content"]))
+        self.revalidate_after = revalidate_after
+        self.folder = folder
+        self._revalidating = set()
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+
+    def _path(self, key):
+        bucket, object_name = key
+        return os.path.join(self.folder, bucket, object_name)
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path + ".meta.json") as f:
+                meta = json.load(f)
+            with open(path, "rb") as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+        entry = {"content": content, **meta}
+        self.memory.set(key, entry)
+        return entry
+
+    def _store(self, key, entry, content=True):
+        # without `content`, only the metadata is written, the file being unchanged
+        self.memory.set(key, entry)
+        path = self._path(key)
+        try:
+            if content:
+                write_atomically(path, entry["content"])
+            write_atomically(
+                path + ".meta.json",
+                json.dumps(
+                    {"etag": entry["etag"], "checked_at": entry["checked_at"]}
+                ).encode(),
+            )
+        except OSError as e:
+            print(e)
+
+    def _fetch(self, client, key):
+        r = client.get_object(*key)
+        try:
+            content = r.read()
+            etag = r.headers.get("ETag", "").strip('"')
+        finally:
+            r.close()
+            r.release_conn()
+        entry = {"content": content, "etag": etag, "checked_at": time.time()}
+        self._store(key, entry)
+        return entry
+
+    def _check(self, client, key, entry):
+        try:
+            etag = client.stat_object(*key).etag.strip('"')
+            if etag == entry["etag"]:
+                entry = {**entry, "checked_at": time.time()}
+                self._store(key, entry, content=False)
+                return entry
+            return self._fetch(client, key)
+        except Exception as e:
+            # keep serving the stale version, we'll try again on next access
+            print(e)
+            return entry
+
+    def _revalidate(self, client, key, entry):
+        try:
+            self._check(client, key, entry)
+        finally:
+            with self._lock:
+                self._revalidating.discard(key)
+
+    def _revalidate_in_background(self, client, key, entry):
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+        threading.Thread(
+            target=self._revalidate, args=(client, key, entry), daemon=True
+        ).start()
+
+    def get(self, client, bucket, object_name, revalidate=False):
+        # with `revalidate`, the version is checked before returning, for reads
+        # that must be up to date (background jobs, forced refreshes)
+        key = (bucket, object_name)
+        entry = self.memory.get(key) or self._read_disk(key)
+        if entry is None:
+            entry = self._flights.do(key, lambda: self._fetch(client, key))
+        elif revalidate:
+            entry = self._flights.do(key, lambda: self._check(client, key, entry))
+        elif time.time() - entry["checked_at"] > self.revalidate_after:
+            self._revalidate_in_background(client, key, entry)
+        return entry["content"], entry["etag"]
+
+
+class ResourceFileCache:
+    """
+    Disk cache of files served over HTTP, such as data.gouv.fr/fr/datasets/r/... URLs.
+    The redirect to the actual file is followed once per check, and the file is
+    revalidated with If-None-Match/If-Modified-Since, then streamed to disk
+    only if it changed.
+    """
+
+    def __init__(
+        self,
+        revalidate_after=60,
+        folder=os.path.join(cache_folder, "resources"),
+        chunk_size=1024**2,
+    ):
+        self.revalidate_after = revalidate_after
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _path(self, url):
+        return os.path.join(self.folder, hashlib.sha1(url.encode()).hexdigest())
+
+    def _read_meta(self, path):
+        try:
+            with open(path + ".meta.json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _download(self, url, path, meta):
+        # closed before its body is read, in case the URL serves the file itself
+        with http_client.get(url, allow_redirects=False, stream=True) as r:
+            location = r.headers["Location"] if r.is_redirect else url
+        headers = {}
+        # the validators only hold for the file we downloaded
+        if os.path.exists(path) and meta.get("location") == location:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        with http_client.get(location, headers=headers, stream=True) as r:
+            if r.status_code != 304:
+                r.raise_for_status()
+                os.makedirs(self.folder, exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+                os.replace(tmp, path)
+                meta = {
+                    "location": location,
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                }
+        meta = {**meta, "checked_at": time.time()}
+        write_atomically(path + ".meta.json", json.dumps(meta).encode())
+        return meta
+
+    def get(self, url):
+        # returns (path of the local copy, version of the file)
+        path = self._path(url)
+        with self._lock:
+            lock = self._locks.setdefault(url, threading.Lock())
+        # a single download per file at a time
+        with lock:
+            meta = self._read_meta(path)
+            if (
+                not os.path.exists(path)
+                or time.time() - meta.get("checked_at", 0) > self.revalidate_after
+            ):
+                try:
+                    meta = self._download(url, path, meta)
+                except Exception as e:
+                    if not os.path.exists(path) or "location" not in meta:
+                        raise
+                    # keep using the local copy, we'll try again on next access
+                    print(e)
+        return path, meta.get("etag") or meta.get("last_modified") or meta["location"]
+
+
+class ParsedArtifacts:
+    """Registry of parsed files, so that each version of a file is parsed only once."""
+
+    def __init__(self):
+        self._artifacts = {}
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+
+    def _parse(self, key, version, parse):
+        parsed = parse()
+        with self._lock:
+            # only the latest version of each artifact is kept in memory
+            self._artifacts[key] = (version, parsed)
+        return parsed
+
+    def get(self, key, version, parse):
+        with self._lock:
+            current = self._artifacts.get(key)
+        if current is not None and current[0] == version:
+            return current[1]
+        return self._flights.do(
+            (key, version), lambda: self._parse(key, version, parse)
+        )
+
+
+def read_local_json(file_name, default=None):
+    try:
+        with open(os.path.join(cache_folder, file_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_local_json(file_name, data):
+    write_atomically(os.path.join(cache_folder, file_name), json.dumps(data).encode())
+
+
+class PersistedResource:
+    """
+    Resource built by `build` on first use, persisted locally so that a cold start
+    uses the last good copy, and rebuilt in the background once older than `ttl`.
+    """
+
+    def __init__(self, file_name, build, ttl):
+        self.file_name = file_name
+        self.build = build
+        self.ttl = ttl
+        self.value = None
+        self.built_at = 0
+        self._loaded = False
+        # the local copy has its own lock, so that reading it never waits for a build
+        self._load_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._load_lock:
+            if self._loaded:
+                return
+            local = read_local_json(self.file_name, {})
+            if self.value is None:
+                self.value = local.get("value")
+                self.built_at = local.get("built_at", 0)
+            self._loaded = True
+
+    def _refresh(self):
+        try:
+            value = self.build()
+        except Exception as e:
+            # we'll keep using the last good copy
+            print(e)
+            return
+        self.value, self.built_at = value, time.time()
+        write_local_json(
+            self.file_name, {"built_at": self.built_at, "value": self.value}
+        )
+
+    def refresh_in_background(self):
+        if not self._lock.acquire(blocking=False):
+            # already being refreshed
+            return
+
+        def _refresh():
+            try:
+                self._refresh()
+            finally:
+                self._lock.release()
+
+        threading.Thread(target=_refresh, daemon=True).start()
+
+    def get(self, wait=True):
+        # without a copy yet and if wait is False, returns None
+        # and builds the resource in the background
+        if self.value is None:
+            self._load()
+        if self.value is None:
+            if wait:
+                with self._lock:
+                    if self.value is None:
+                        self._refresh()
+            else:
+                self.refresh_in_background()
+        elif time.time() - self.built_at > self.ttl:
+            self.refresh_in_background()
+        return self.value
+
+
+class LookupCache:
+    """
+    Persisted results of lookups on external APIs, each kept for the TTL of its
+    status (e.g. "found", "not_found"), so that missing results are cached too.
+    New results are written by `flush`, merged with those of the other processes,
+    or once `flush_every` of them are pending.
+    """
+
+    def __init__(self, file_name, ttls, flush_every=100):
+        self.file_name = file_name
+        self.ttls = ttls
+        self.flush_every = flush_every
+        self._entries = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def _is_fresh(self, entry, now):
+        return now - entry["at"] <= self.ttls[entry["status"]]
+
+    def _merge(self, entries, new_entries):
+        # keeps the latest result of each key
+        for key, entry in new_entries.items():
+            if key not in entries or entries[key]["at"] < entry["at"]:
+                entries[key] = entry
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = read_local_json(self.file_name, {})
+
+    def get(self, key):
+        # returns (status, value), or None if the key is missing or expired
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+        if entry is None or not self._is_fresh(entry, time.time()):
+            return None
+        return entry["status"], entry["value"]
+
+    def set_many(self, results):
+        # results: {key: (status, value)}, keys being strings to be stored as JSON
+        now = time.time()
+        with self._lock:
+            self._load()
+            for key, (status, value) in results.items():
+                entry = {"status": status, "value": value, "at": now}
+                self._entries[key] = self._pending[key] = entry
+            full = len(self._pending) >= self.flush_every
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            now = time.time()
+            # the file may have been updated by another process since
+            entries = read_local_json(self.file_name, {})
+            self._merge(entries, pending)
+            entries = {
+                key: entry
+                for key, entry in entries.items()
+                if self._is_fresh(entry, now)
+            }
+            try:
+                write_local_json(self.file_name, entries)
+            except OSError as e:
+                print(e)
+            with self._lock:
+                for key, entry in list(self._entries.items()):
+                    if not self._is_fresh(entry, now):
+                        del self._entries[key]
+                # also picking up the lookups made by the other processes
+                self._merge(self._entries, entries)
@@ -6,30 +6,40 @@ from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import json
-import requests
 import random
 import plotly.express as px
 
 from my_secrets import (
     DATAGOUV_API_KEY,
 )
+from tabs import enrichment, http_client, scheduler
+from tabs.cache import read_local_json, write_local_json
+from tabs.enrichment import get_valid_domains, search_company
 from tabs.utils import (
     bucket,
     folder,
     client,
     max_displayed_suggestions,
+    enrich_concurrently,
     get_file_content,
     get_latest_day_of_each_month,
     every_second_row_style,
+    only_in_selected_tab,
 )
 
 
 suggestions_file = "suggestions.csv"
+# stats of the months that are over, their files won't change anymore
+# {month: stats of its last day, as returned by get_month_stats}
+certif_history_file = "certif_history.json"
 
 
 tab_certif = dcc.Tab(
     label="Certification",
+    value="certif",
     children=[
         dbc.Row(
             [
@@ -42,6 +52,7 @@ tab_certif = dcc.Tab(
                     ]
                 ),
                 dcc.Graph(id="certif:graph"),
+                dcc.Graph(id="certif:graph_deltas"),
             ],
             style={"padding": "15px 0px 5px 0px"},
         ),
@@ -92,31 +103,17 @@ def is_certified(badges):
     return False
 
 
-def get_valid_domains(siret):
-    if not siret:
-        return set()
-    r = requests.get(
-        "https://tabular-api.data.gouv.fr/api/resources/4208f064-e655-4bad-93c9-9a3977f3f8cc/"
-        f"data/?siret__exact={siret}&page_size=50"
-    )
-    r.raise_for_status()
-    return set(d["domain_email"] for d in r.json()["data"])
-
-
 def guess_valid_badge(siret):
-    r = requests.get(
-        "https://recherche-entreprises.api.gouv.fr/search?q=" + siret,
-    ).json()["results"]
-    if len(r) > 1:
+    status, company = search_company(siret)
+    if status == "ambiguous":
         return None, "Plusieurs résultats pour ce SIRET : " + siret
-    elif len(r) == 0:
+    elif status == "not_found":
         return None, "Aucun résultat pour ce SIRET : " + siret
-    complements = r[0]["complements"]
-    if complements["collectivite_territoriale"] and complements["est_service_public"]:
+    if company["collectivite_territoriale"] and company["est_service_public"]:
         return "local-authority", "Reconnu comme `SP` et `ColTer` => badge `ColTer`"
-    elif complements["collectivite_territoriale"]:
+    elif company["collectivite_territoriale"]:
         return "local-authority", "Reconnu comme `collectivité territoriale`"
-    elif complements["est_service_public"]:
+    elif company["est_service_public"]:
         return "public-service", "Reconnu comme `service public`"
     return None, "Ce message ne devrait jamais s'afficher, siret : " + siret
 
@@ -137,14 +134,41 @@ def certify_button(idx, orga_id, badge, current_badges):
     )
 
 
+def load_month_ids(day):
+    # as sets so that all the differences below are linear
+    return tuple(
+        set(json.loads(get_file_content(day + "/" + file, revalidate=True)))
+        for file in ["certified.json", "SP_or_CT.json"]
+    )
+
+
+def get_month_stats(day, ids, previous_ids=None):
+    certified, SP_or_CT = ids
+    stats = {
+        "day": day,
+        "certified": len(certified),
+        "not_certified": len(SP_or_CT - certified),
+        "newly_certified": None,
+        "lost_certification": None,
+        "newly_eligible": None,
+    }
+    if previous_ids is not None:
+        previous_certified, previous_SP_or_CT = previous_ids
+        stats.update(
+            {
+                "newly_certified": len(certified - previous_certified),
+                "lost_certification": len(previous_certified - certified),
+                "newly_eligible": len(SP_or_CT - previous_SP_or_CT),
+            }
+        )
+    return stats
+
+
 def create_certif_graph(stats):
     data = {
         "Mois": stats.keys(),
-        "Orgas certifiées": [len(k["certified"]) for k in stats.values()],
-        "SP ou CT non certifiés": [
-            len([o for o in k["SP_or_CT"] if o not in k["certified"]])
-            for k in stats.values()
-        ],
+        "Orgas certifiées": [k["certified"] for k in stats.values()],
+        "SP ou CT non certifiés": [k["not_certified"] for k in stats.values()],
     }
     df = pd.DataFrame(data)
     df = pd.melt(
@@ -169,79 +193,106 @@ def create_certif_graph(stats):
     return fig
 
 
-# %% Callbacks
-@dash.callback(
-    [
-        Output("certif:graph", "figure"),
-        Output("certif:suggestions", "children"),
-        Output("certif:issues", "children"),
-        Output("certif:datastore", "data"),
-    ],
-    [Input("certif:button_refresh", "n_clicks")],
-)
-def refresh_certif(click):
-    certif_dates = [
-        f.object_name.replace(folder, "")[:-1]
-        for f in client.list_objects(bucket, prefix=folder)
-        if f.object_name.replace(folder, "").startswith("20")
-    ]
-    last_days = get_latest_day_of_each_month(certif_dates)
-    stats = {}
-    for idx, month in enumerate(last_days):
-        stats[month] = {}
-        for file in ["certified.json", "SP_or_CT.json"]:
-            stats[month][file.replace(".json", "")] = json.loads(
-                get_file_content(last_days[month] + "/" + file)
-            )
-        if idx == len(last_days) - 1:
-            issues = json.loads(
-                get_file_content(last_days[month] + "/" + "issues.json")
-            )
-            certified = stats[month]["certified"]
-            SP_or_CT = stats[month]["SP_or_CT"]
+def create_certif_deltas_graph(stats):
+    months = [m for m in stats if stats[m]["newly_certified"] is not None]
+    df = pd.DataFrame(
+        {
+            "Mois": months,
+            "Nouvelles certifications": [stats[m]["newly_certified"] for m in months],
+            "Certifications perdues": [stats[m]["lost_certification"] for m in months],
+            "Nouveaux SP ou CT": [stats[m]["newly_eligible"] for m in months],
+        }
+    )
+    df = pd.melt(
+        df,
+        id_vars=["Mois"],
+        var_name="Évolution sur le mois",
+        value_name="Nombre",
+    )
+    fig = px.bar(
+        df,
+        x="Mois",
+        y="Nombre",
+        color="Évolution sur le mois",
+        barmode="group",
+        text_auto=True,
+    )
+    fig.update_layout(
+        xaxis=dict(
+            tickformat="%b 20%y",
+        )
+    )
+    return fig
+
 
-    session = requests.Session()
-    suggestions = [o for o in SP_or_CT if o not in certified]
-    # to see more than just the first ones
+def enrich_suggestion(orga_id):
+    params = http_client.get(
+        f"https://www.data.gouv.fr/api/1/organizations/{orga_id}/",
+        headers={
+            "X-fields": "name,created_at,badges,members{user{email}},business_number_id",
+            "X-API-KEY": DATAGOUV_API_KEY,
+        },
+    ).json()
+    # to prevent showing orgas that have been certified since last DAG run
+    if "badges" not in params or is_certified(params["badges"]):
+        return None
+    emails = [u["user"]["email"] for u in params["members"]]
+    badge, text = guess_valid_badge(params["business_number_id"])
+    return {
+        "id": orga_id,
+        "params": params,
+        "current_badges": [b["kind"] for b in params["badges"]],
+        "emails": emails,
+        "badge": badge,
+        "text": text,
+    }
+
+
+def build_suggestions(candidates):
+    # drawn and checked on each refresh, so that organizations certified since
+    # the last run of the job are not suggested again
+    suggestions = list(candidates)
+    # to see more than just the first ones, and not the same ones as other users
     random.shuffle(suggestions)
+    # for performance purposes, only displaying X suggestions
+    # refresh when work is done to certify more
+    rate_limits_before = http_client.rate_limit_stats()
+    suggestions = enrich_concurrently(
+        suggestions, enrich_suggestion, max_displayed_suggestions
+    )
+    # one query for the domains of all the displayed suggestions
+    try:
+        domains = get_valid_domains(
+            suggestion["params"]["business_number_id"] for suggestion in suggestions
+        )
+    except Exception as e:
+        print(e)
+        domains = {}
+    enrichment.flush()
+    http_client.print_rate_limit_waits(rate_limits_before, "Certif refresh")
+    for suggestion in suggestions:
+        suggestion["present_domains"] = [
+            domain
+            for domain in domains.get(suggestion["params"]["business_number_id"], [])
+            if any(email.endswith("@" + domain) for email in suggestion["emails"])
+        ]
     suggestions_divs = []
     suggestions_data = []
 
-    for idx, orga_id in enumerate(suggestions):
-        # for performance purposes, only displaying X suggestions
-        # refresh when work is done to certify more
-        if len(suggestions_divs) == max_displayed_suggestions:
-            break
-        params = session.get(
-            f"https://www.data.gouv.fr/api/1/organizations/{orga_id}/",
-            headers={
-                "X-fields": "name,created_at,badges,members{user{email}},business_number_id",
-                "X-API-KEY": DATAGOUV_API_KEY,
-            },
-        ).json()
-        # to prevent showing orgas that have been certified since last DAG run
-        if "badges" not in params or is_certified(params["badges"]):
-            continue
-        current_badges = [b["kind"] for b in params["badges"]]
-        emails = [u["user"]["email"] for u in params["members"]]
-        valid_domains = get_valid_domains(params["business_number_id"])
-        badge, text = guess_valid_badge(params["business_number_id"])
-        present_domains = []
-        for domain in valid_domains:
-            if any(email.endswith("@" + domain) for email in emails):
-                present_domains.append(domain)
+    for idx, suggestion in enumerate(suggestions):
+        orga_id, params = suggestion["id"], suggestion["params"]
         md = (
             f"- [{params['name']}]"
             f"(https://www.data.gouv.fr/fr/organizations/{orga_id}/)"
         )
-        if current_badges:
-            md += f", badge actuel : `{', '.join(current_badges)}`"
-        if not emails:
+        if suggestion["current_badges"]:
+            md += f", badge actuel : `{', '.join(suggestion['current_badges'])}`"
+        if not suggestion["emails"]:
             md += "\n   - Pas de membres dans cette organisation"
-        for email in emails:
+        for email in suggestion["emails"]:
             md += "\n   - " + email
-        if present_domains:
-            md += f"\n\n✅ Emails vérifiés: {', '.join(present_domains)}"
+        if suggestion["present_domains"]:
+            md += f"\n\n✅ Emails vérifiés: {', '.join(suggestion['present_domains'])}"
         suggestions_divs += [
             dbc.Row(
                 children=[
@@ -249,10 +300,15 @@ def refresh_certif(click):
                     dbc.Col(
                         children=[
                             html.Div(
-                                certify_button(idx, orga_id, badge, current_badges),
+                                certify_button(
+                                    idx,
+                                    orga_id,
+                                    suggestion["badge"],
+                                    suggestion["current_badges"],
+                                ),
                                 style={"padding": "10px 0px 0px 0px"},
                             ),
-                            dcc.Markdown(text),
+                            dcc.Markdown(suggestion["text"]),
                         ]
                     ),
                 ],
@@ -264,29 +320,118 @@ def refresh_certif(click):
                 "name": params["name"],
                 "created_at": params["created_at"][:10],
                 "url": f"https://www.data.gouv.fr/fr/organizations/{orga_id}/",
-                "emails": "; ".join(emails),
+                "emails": "; ".join(suggestion["emails"]),
             }
         )
 
+    return suggestions_divs, suggestions_data
+
+
+@scheduler.job("certif", every=3600)
+def build_certif():
+    history = read_local_json(certif_history_file, {})
+    # only listing from the last closed month, which we need to list again
+    # in case there is nothing yet for the current month
+    certif_dates = [
+        f.object_name.replace(folder, "")[:-1]
+        for f in client.list_objects(
+            bucket,
+            prefix=folder,
+            start_after=folder + history[max(history)]["day"] if history else None,
+        )
+        if f.object_name.replace(folder, "").startswith("20")
+    ]
+    last_days = get_latest_day_of_each_month(certif_dates)
+    current_month = datetime.now().strftime("%Y-%m")
+    latest_month = max(last_days)
+    days = {month: month_stats["day"] for month, month_stats in history.items()}
+    days.update(last_days)
+    months = sorted(days)
+    stats = dict(history)
+    ids = {}
+    recomputed = set()
+    for idx, month in enumerate(months):
+        # a stored month is computed again if a later day of it was listed since
+        # (e.g. its last day was uploaded after we stored it), and so is the month
+        # after it, whose deltas depend on it
+        if (
+            month in history
+            and history[month]["day"] == days[month]
+            and month != latest_month
+            and (idx == 0 or months[idx - 1] not in recomputed)
+        ):
+            continue
+        recomputed.add(month)
+        ids[month] = load_month_ids(days[month])
+        previous_ids = None
+        if idx > 0:
+            if months[idx - 1] not in ids:
+                ids[months[idx - 1]] = load_month_ids(days[months[idx - 1]])
+            previous_ids = ids[months[idx - 1]]
+        stats[month] = get_month_stats(days[month], ids[month], previous_ids)
+        if month < current_month:
+            history[month] = stats[month]
+    write_local_json(certif_history_file, history)
+    stats = dict(sorted(stats.items()))
+    certified, SP_or_CT = ids[latest_month]
+    issues = json.loads(
+        get_file_content(last_days[latest_month] + "/issues.json", revalidate=True)
+    )
+
     issues_md = ""
     if issues:
         issues_md += "## Liste des SIRETs qui posent problème :"
-    for i in issues:
-        name = session.get(
-            f"https://www.data.gouv.fr/api/1/organizations/{list(i.keys())[0]}/",
-            headers={"X-fields": "name"},
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        names = executor.map(
+            lambda i: http_client.get(
+                f"https://www.data.gouv.fr/api/1/organizations/{list(i.keys())[0]}/",
+                headers={"X-fields": "name"},
+            ),
+            issues,
         )
-        if name.ok:
-            name = name.json()["name"]
-            issues_md += (
-                f"\n- [{name}](https://www.data.gouv.fr/fr/organizations/"
-                f"{list(i.keys())[0]}) : {list(i.values())[0]}"
-            )
+        for i, name in zip(issues, names):
+            if name.ok:
+                name = name.json()["name"]
+                issues_md += (
+                    f"\n- [{name}](https://www.data.gouv.fr/fr/organizations/"
+                    f"{list(i.keys())[0]}) : {list(i.values())[0]}"
+                )
 
     return (
         create_certif_graph(stats),
-        suggestions_divs,
+        create_certif_deltas_graph(stats),
         [dcc.Markdown(issues_md)],
+        # the organizations to certify, drawn from on each refresh
+        sorted(SP_or_CT - certified),
+    )
+
+
+# %% Callbacks
+@dash.callback(
+    [
+        Output("certif:graph", "figure"),
+        Output("certif:graph_deltas", "figure"),
+        Output("certif:suggestions", "children"),
+        Output("certif:issues", "children"),
+        Output("certif:datastore", "data"),
+    ],
+    [
+        Input("certif:button_refresh", "n_clicks"),
+        Input("tabs", "value"),
+    ],
+    [State("certif:graph", "figure")],
+)
+def refresh_certif(click, tab, figure):
+    only_in_selected_tab("certif", tab, figure)
+    graph, deltas_graph, issues, candidates = scheduler.get(
+        "certif", force=dash.ctx.triggered_id == "certif:button_refresh"
+    )
+    suggestions_divs, suggestions_data = build_suggestions(candidates)
+    return (
+        graph,
+        deltas_graph,
+        suggestions_divs,
+        issues,
         {"suggestions": suggestions_data},
     )
 
@@ -311,12 +456,12 @@ def update_after_certif(*args):
     to_add = [b for b in [badge, "certified"] if b not in current_badges]
     to_remove = [b for b in current_badges if b not in [badge, "certified"]]
     for b in to_remove:
-        requests.delete(
+        http_client.delete(
             f"https://www.data.gouv.fr/api/1/organizations/{orga_id}/badges/{b}/",
             headers={"X-API-KEY": DATAGOUV_API_KEY},
         )
     for b in to_add:
-        r = requests.post(
+        r = http_client.post(
             f"https://www.data.gouv.fr/api/1/organizations/{orga_id}/badges/",
             json={"kind": b},
             headers={"X-API-KEY": DATAGOUV_API_KEY},
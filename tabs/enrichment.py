@@ -0,0 +1,107 @@
+from urllib.parse import urlencode
+
+from tabs import http_client
+from tabs.cache import LookupCache, SingleFlight
+
+entreprises_api_url = "https://recherche-entreprises.api.gouv.fr/search?q="
+domains_api_url = (
+    "https://tabular-api.data.gouv.fr/api/resources/"
+    "4208f064-e655-4bad-93c9-9a3977f3f8cc/data/"
+)
+# number of SIRETs filtered on in one tabular-api query
+domains_batch_size = 50
+
+day = 24 * 3600
+# a missing or ambiguous result is more likely to be fixed upstream than a found one
+companies = LookupCache(
+    "companies.json",
+    ttls={"found": 30 * day, "not_found": 7 * day, "ambiguous": 7 * day},
+)
+valid_domains = LookupCache(
+    "valid_domains.json", ttls={"found": 7 * day, "not_found": day}
+)
+# concurrent lookups of the same company share one call
+company_searches = SingleFlight()
+
+
+def search_company(query):
+    """
+    Searches a SIREN or SIRET on recherche-entreprises, returns (status, value):
+    - ("found", {"siret", "collectivite_territoriale", "est_service_public"})
+    - ("ambiguous", number of results)
+    - ("not_found", None)
+    Errors are raised, and not cached.
+    """
+    cached = companies.get(query)
+    if cached is not None:
+        return cached
+    return company_searches.do(query, lambda: fetch_company(query))
+
+
+def fetch_company(query):
+    r = http_client.get(entreprises_api_url + query)
+    r.raise_for_status()
+    results = r.json()["results"]
+    if len(results) == 0:
+        result = ("not_found", None)
+    elif len(results) > 1:
+        result = ("ambiguous", len(results))
+    else:
+        complements = results[0]["complements"]
+        result = (
+            "found",
+            {
+                "siret": results[0]["siege"]["siret"],
+                "collectivite_territoriale": complements["collectivite_territoriale"],
+                "est_service_public": complements["est_service_public"],
+            },
+        )
+    companies.set_many({query: result})
+    return result
+
+
+def flush():
+    # writes the lookups made since the last flush, at the end of each refresh
+    companies.flush()
+    valid_domains.flush()
+
+
+def get_valid_domains(sirets):
+    """
+    Returns {siret: set of the email domains validated for this SIRET}.
+    The SIRETs that are not cached are filtered on by batches, in one query each.
+    """
+    domains = {}
+    missing = []
+    for siret in set(s for s in sirets if s):
+        cached = valid_domains.get(siret)
+        if cached is None:
+            missing.append(siret)
+        else:
+            domains[siret] = set(cached[1])
+    for start in range(0, len(missing), domains_batch_size):
+        found = {siret: set() for siret in missing[start : start + domains_batch_size]}
+        url = (
+            domains_api_url
+            + "?"
+            + urlencode({"siret__in": ",".join(found), "page_size": 50})
+        )
+        while url:
+            r = http_client.get(url)
+            r.raise_for_status()
+            r = r.json()
+            for row in r["data"]:
+                if str(row["siret"]) in found:
+                    found[str(row["siret"])].add(row["domain_email"])
+            url = r["links"].get("next")
+        valid_domains.set_many(
+            {
+                siret: (
+                    "found" if siret_domains else "not_found",
+                    sorted(siret_domains),
+                )
+                for siret, siret_domains in found.items()
+            }
+        )
+        domains.update(found)
+    return domains
@@ -0,0 +1,165 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+default_timeout = 10
+
+# size of the keep-alive connection pool of each host we call,
+# sized after the number of concurrent calls we make to them
+pool_sizes = {
+    "www.data.gouv.fr": 20,
+    "tabular-api.data.gouv.fr": 10,
+    "recherche-entreprises.api.gouv.fr": 10,
+    "grist.numerique.gouv.fr": 2,
+}
+
+# POST requests are only retried if they could not be sent at all
+retries = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    raise_on_status=False,
+)
+
+
+class TokenBucket:
+    """
+    Process-wide limit of `rate` calls per second, allowing bursts of `capacity`.
+    Callers queue by reserving the next token, and sleep until it is available.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.calls = 0
+        self.delayed_calls = 0
+        self.total_wait = 0
+        self.max_wait = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, 0)
+            self.calls += 1
+            if wait:
+                self.delayed_calls += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "delayed_calls": self.delayed_calls,
+                "total_wait": round(self.total_wait, 2),
+                "max_wait": round(self.max_wait, 2),
+            }
+
+
+# calls per second allowed by the hosts that enforce a limit
+rate_limits = {
+    "recherche-entreprises.api.gouv.fr": TokenBucket(rate=7),
+}
+
+
+def rate_limit_stats():
+    # a growing total_wait means the rate limit is what slows the refreshes down
+    return {host: bucket.stats() for host, bucket in rate_limits.items()}
+
+
+def print_rate_limit_waits(before, label):
+    # prints the calls delayed by the rate limits since the `before` stats,
+    # if any, e.g. during a refresh
+    for host, stats in rate_limit_stats().items():
+        delayed = stats["delayed_calls"] - before[host]["delayed_calls"]
+        if delayed:
+            wait = stats["total_wait"] - before[host]["total_wait"]
+            print(f"{label}: {delayed} calls to {host} delayed by {wait:.2f}s in total")
+
+
+# the hosts with a rate limit are only retried by urllib3 when the request could
+# not be sent, `request` retries their error statuses so that each attempt takes
+# a token
+rate_limited_retries = Retry(
+    total=retries.total,
+    read=0,
+    backoff_factor=retries.backoff_factor,
+    raise_on_status=False,
+)
+
+# adapters hold the connection pools (which are thread-safe),
+# so they are shared by all threads of the process
+adapters = {
+    host: HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=size,
+        max_retries=rate_limited_retries if host in rate_limits else retries,
+    )
+    for host, size in pool_sizes.items()
+}
+default_adapter = HTTPAdapter(max_retries=retries)
+local = threading.local()
+
+
+def get_session():
+    # sessions are not thread-safe (cookies...), so we keep one per thread
+    # that all use the same process-wide connection pools
+    session = getattr(local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.mount("http://", default_adapter)
+        session.mount("https://", default_adapter)
+        for host, adapter in adapters.items():
+            session.mount(f"https://{host}/", adapter)
+        local.session = session
+    return session
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault("timeout", default_timeout)
+    bucket = rate_limits.get(urlsplit(url).hostname)
+    if bucket is None:
+        return get_session().request(method, url, **kwargs)
+    for attempt in range(retries.total + 1):
+        bucket.acquire()
+        r = get_session().request(method, url, **kwargs)
+        if attempt == retries.total or not retries.is_retry(method, r.status_code):
+            return r
+        r.close()
+        retry_after = r.headers.get("Retry-After", "")
+        time.sleep(
+            int(retry_after)
+            if retry_after.isdigit()
+            else retries.backoff_factor * 2**attempt
+        )
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
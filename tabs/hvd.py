@@ -3,26 +3,37 @@ from dash import dcc
 from dash import html
 from dash import dash_table
 import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import json
-import requests
+from functools import partial
+from itertools import islice
 from unidecode import unidecode
-# from random import shuffle
 
+from tabs import http_client, scheduler
+from tabs.cache import PersistedResource, read_local_json, write_local_json
 from tabs.utils import (
     DATASETS_QUALITY_METRICS,
     DATASERVICES_QUALITY_METRICS,
     max_displayed_suggestions,
     get_file_content,
+    files_version,
+    get_parsed_file,
+    memoize_figure,
+    only_in_selected_tab,
+    resources_types_figure,
+    parse_monthly_stats,
     get_latest_day_of_each_month,
     first_day_same_month,
     get_all_from_api_query,
+    reservoir_sample,
+    revalidate_files,
     client,
 )
 
@@ -34,61 +45,153 @@ def slugify(s: str) -> str:
 ouverture_hvd_api = (
     "https://grist.numerique.gouv.fr/api/docs/eJxok2H2va3E/tables/Hvd/records"
 )
-r = requests.get(ouverture_hvd_api).json()
-categories = {
-    slugify(cat): cat for cat in set(k["fields"]["Thematique"] for k in r["records"])
-}
-df_ouverture = pd.DataFrame([k["fields"] for k in r["records"]])
-dfs = []
-for _type in ["Telechargement", "API"]:
-    tmp = df_ouverture[
-        ["Titre", "Ensemble_de_donnees", "Thematique"]
-        + [c for c in df_ouverture.columns if c.endswith(_type)]
-    ]
-    tmp["type"] = "dataservices" if _type == "API" else "datasets"
-    tmp.rename(
-        {
-            c: c.replace(f"_{_type}", "")
-            for c in df_ouverture.columns
-            if c.endswith(_type)
+# {file: {"etag": str, "mean": float, "count": int}}
+hvd_history_file = "hvd_quality_history.json"
+
+
+def build_hvd_reference():
+    records = http_client.get(ouverture_hvd_api).json()["records"]
+    # indexing the rows by data.gouv URL to join them with the API results
+    by_url = {}
+    for record in records:
+        fields = record["fields"]
+        for _type in ["Telechargement", "API"]:
+            if fields.get(f"URL_{_type}"):
+                by_url.setdefault(fields[f"URL_{_type}"], []).append(
+                    {
+                        "Ensemble_de_donnees": fields.get("Ensemble_de_donnees"),
+                        "Thematique": fields.get("Thematique"),
+                    }
+                )
+    return {
+        "categories": {
+            slugify(cat): cat
+            for cat in set(k["fields"].get("Thematique") for k in records)
+            if cat
         },
-        axis=1,
-        inplace=True,
+        "by_url": by_url,
+    }
+
+
+hvd_reference = PersistedResource("hvd_reference.json", build_hvd_reference, ttl=3600)
+
+
+def get_hvd_reference():
+    # empty while the reference is first built in the background,
+    # so that callbacks never wait for Grist
+    return hvd_reference.get(wait=False) or {"categories": {}, "by_url": {}}
+
+
+def light_object(k):
+    return {
+        "slug": k["slug"],
+        "title": k["title"],
+        "organization": (k["organization"] or {}).get("name"),
+        "tags": k["tags"],
+    }
+
+
+def hvd_objects_query(object_type):
+    return {
+        "base_query": f"https://www.data.gouv.fr/api/1/{object_type}/?tag=hvd",
+        "mask": (
+            "data{title,organization,tags,id,quality,slug}"
+            if object_type == "datasets"
+            else None
+        ),
+    }
+
+
+def is_failing(k, param, object_type):
+    _obj = k["quality"] if object_type == "datasets" else k
+    return not _obj.get(param)
+
+
+def build_objects_index(object_type):
+    # HVD objects failing each quality criterion, from one scan of the catalog
+    params = [
+        m["value"]
+        for m in (
+            DATASETS_QUALITY_METRICS
+            if object_type == "datasets"
+            else DATASERVICES_QUALITY_METRICS
+        )
+        if m["value"] != "score"
+    ]
+    failing = {param: [] for param in params}
+    total = 0
+    for k in get_all_from_api_query(**hvd_objects_query(object_type), ordered=False):
+        total += 1
+        for param in params:
+            if is_failing(k, param, object_type):
+                failing[param].append(light_object(k))
+    return {"total": total, "failing": failing}
+
+
+objects_index = {
+    object_type: PersistedResource(
+        f"hvd_{object_type}_index.json",
+        partial(build_objects_index, object_type),
+        ttl=3600,
+    )
+    for object_type in ["datasets", "dataservices"]
+}
+
+
+def summarize_hvd_file(file):
+    df = pd.read_csv(
+        StringIO(
+            # no need to keep the file, we only keep its summary
+            get_file_content(
+                file,
+                bucket="data-pipeline-open",
+                folder="",
+                cache=False,
+            )
+        ),
+        sep=";",
+        dtype=float,
+        usecols=["score_qualite_hvd"],
     )
-    dfs.append(tmp)
-df_ouverture = pd.concat(dfs)[["URL", "Ensemble_de_donnees", "Thematique"]]
+    return {
+        "mean": round(float(df["score_qualite_hvd"].mean()), 2),
+        "count": len(df),
+    }
 
 
+@scheduler.job("hvd_quality_scores", every=3600)
 def create_quality_score_graph():
-    score_history = [
-        name
+    score_history = {
+        name: obj.etag
         for obj in client.list_objects(
             "data-pipeline-open", prefix="hvd/", recursive=False
         )
         if (name := obj.object_name).endswith("grist_hvd.csv")
+    }
+    # only parsing the files that are new or have changed since last time
+    summaries = read_local_json(hvd_history_file, {})
+    to_parse = [
+        file
+        for file, etag in score_history.items()
+        if summaries.get(file, {}).get("etag") != etag
     ]
+    if to_parse:
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            for file, summary in zip(
+                to_parse, executor.map(summarize_hvd_file, to_parse)
+            ):
+                summaries[file] = {"etag": score_history[file], **summary}
+        summaries = {file: summaries[file] for file in score_history}
+        write_local_json(hvd_history_file, summaries)
     stats = {
         "date": [],
         "mean": [],
         "count": [],
     }
-    for file in score_history:
-        df = pd.read_csv(
-            StringIO(
-                get_file_content(
-                    file,
-                    bucket="data-pipeline-open",
-                    folder="",
-                )
-            ),
-            sep=";",
-            dtype=float,
-            usecols=["score_qualite_hvd"],
-        )
+    for file in sorted(score_history):
         stats["date"].append(file.split("/")[-1][:7] + "-01")
-        stats["mean"].append(round(df["score_qualite_hvd"].mean(), 2))
-        stats["count"].append(len(df))
-        del df
+        stats["mean"].append(summaries[file]["mean"])
+        stats["count"].append(summaries[file]["count"])
     df = pd.DataFrame(stats)
     fig = px.bar(df, x="date", y="mean", text_auto=True)
     fig.add_trace(
@@ -120,6 +223,7 @@ def create_quality_score_graph():
 
 tab_hvd = dcc.Tab(
     label="HVD",
+    value="hvd",
     children=[
         html.H5("Qualité des HVD"),
         dbc.Row(
@@ -175,14 +279,31 @@ tab_hvd = dcc.Tab(
 )
 
 
+@scheduler.job("hvd", every=600)
+def load_hvd_files():
+    # builds the default figures, the HVD reference and the indexes of the objects
+    # before anyone opens the tab
+    revalidate_files(
+        "datasets_quality.json",
+        "hvd_dataservices_quality.json",
+        "resources_stats.json",
+    )
+    quality_figure(DATASETS_QUALITY_METRICS[0]["value"], "datasets")
+    resources_types_figure("hvd", 2)
+    hvd_reference.get(wait=False)
+    for index in objects_index.values():
+        index.get(wait=False)
+
+
 # %% Callbacks
 @dash.callback(
     Output("hvd:quality_scores", "figure"),
-    # this is only to make the graph load with the page
-    [Input("hvd:slider", "value")],
+    [Input("tabs", "value")],
+    [State("hvd:quality_scores", "figure")],
 )
-def update_quality_graph(_):
-    return create_quality_score_graph()
+def update_quality_graph(tab, figure):
+    only_in_selected_tab("hvd", tab, figure)
+    return scheduler.get("hvd_quality_scores")
 
 
 @dash.callback(
@@ -201,38 +322,17 @@ def update_quality_dropdown_options(value):
         return DATASERVICES_QUALITY_METRICS, DATASERVICES_QUALITY_METRICS[0]["value"]
 
 
-@dash.callback(
-    [
-        Output("hvd:datasets_types", "figure"),
-        Output("hvd:datastore", "data"),
-    ],
-    [
-        Input("hvd:dropdown_quality_indicator", "value"),
-        Input("hvd:dropdown_object_type", "value"),
-    ],
-)
-def change_datasets_quality_graph(param, object_type):
-    if not param or not object_type:
-        raise PreventUpdate
-
+@memoize_figure(files_version("datasets_quality.json", "hvd_dataservices_quality.json"))
+def quality_figure(param, object_type):
     if object_type == "datasets":
-        datasets_quality = json.loads(get_file_content("datasets_quality.json"))
-        dates = get_latest_day_of_each_month(datasets_quality.keys())
-        data = []
-        for date in dates.values():
-            if datasets_quality[date].get("hvd"):
-                data.append([date, datasets_quality[date]["hvd"][param]])
-        df = pd.DataFrame(data, columns=("date", "moyenne"))
-        volumes = [
-            [first_day_same_month(d), datasets_quality[d]["count"]["hvd"]]
-            for d in df["date"].unique()
-        ]
-        df["date"] = df["date"].apply(first_day_same_month)
+        datasets_quality = get_parsed_file("datasets_quality.json", parse_monthly_stats)
+        df = datasets_quality.loc[("hvd", param)].rename("moyenne").reset_index()
+        volumes = datasets_quality.loc[("count", "hvd")].reindex(df["date"])
         object_text = "de jeux de données"
 
     elif object_type == "dataservices":
-        dataservices_quality = json.loads(
-            get_file_content("hvd_dataservices_quality.json")
+        dataservices_quality = get_parsed_file(
+            "hvd_dataservices_quality.json", json.loads
         )
         dates = get_latest_day_of_each_month(dataservices_quality.keys())
         data = []
@@ -248,18 +348,18 @@ def change_datasets_quality_graph(param, object_type):
                     ]
                 )
         df = pd.DataFrame(data, columns=("date", "moyenne"))
-        volumes = [
-            [first_day_same_month(d), dataservices_quality[d]["count"]]
-            for d in df["date"].unique()
-        ]
+        volumes = pd.Series(
+            [dataservices_quality[d]["count"] for d in df["date"]],
+            index=df["date"].apply(first_day_same_month),
+        )
         df["date"] = df["date"].apply(first_day_same_month)
         object_text = "d'APIs"
 
     fig = px.bar(df, x="date", y="moyenne", text_auto=True)
     fig.add_trace(
         go.Scatter(
-            x=[v[0] for v in volumes],
-            y=[v[1] for v in volumes],
+            x=volumes.index,
+            y=volumes.values,
             mode="lines",
             name=f"Nombre {object_text}",
             yaxis="y2",
@@ -276,68 +376,114 @@ def change_datasets_quality_graph(param, object_type):
             title=f"Nombre {object_text}",
             overlaying="y",
             side="right",
-            range=[0, max([v[1] for v in volumes]) * 1.1],
+            range=[0, volumes.max() * 1.1],
         ),
         legend=dict(orientation="h", y=1.1, x=0),
     )
     return fig, {"progression": df.iloc[-1]["moyenne"]}
 
 
+@dash.callback(
+    [
+        Output("hvd:datasets_types", "figure"),
+        Output("hvd:datastore", "data"),
+    ],
+    [
+        Input("hvd:dropdown_quality_indicator", "value"),
+        Input("hvd:dropdown_object_type", "value"),
+        Input("tabs", "value"),
+    ],
+    [State("hvd:datasets_types", "figure")],
+)
+def change_datasets_quality_graph(param, object_type, tab, figure):
+    if not param or not object_type:
+        raise PreventUpdate
+    only_in_selected_tab("hvd", tab, figure)
+    return quality_figure(param, object_type)
+
+
 @dash.callback(
     Output("hvd:objects_to_improve", "children"),
     [
         Input("hvd:dropdown_quality_indicator", "value"),
         Input("hvd:dropdown_object_type", "value"),
         Input("hvd:datastore", "data"),
+        Input("tabs", "value"),
     ],
+    [State("hvd:objects_to_improve", "children")],
 )
-def display_objects_to_improve(param, object_type, store):
+def display_objects_to_improve(param, object_type, store, tab, children):
     if not param or not object_type:
         raise PreventUpdate
+    only_in_selected_tab("hvd", tab, children)
     if store.get("progression") == 1:
         return None
     if param == "score":
         return None
-    r = get_all_from_api_query(
-        f"https://www.data.gouv.fr/api/1/{object_type}/?tag=hvd",
-        mask=(
-            "data{title,organization,tags,id,quality,slug}"
-            if object_type == "datasets"
-            else None
-        ),
-    )
-    # so that we don't always show the same ones
-    # but that's slow (turning generator to list)
-    # shuffle(r)
-    missing = []
-    for k in r:
-        if len(missing) == max_displayed_suggestions:
-            break
-        _obj = k
-        if object_type == "datasets":
-            _obj = k["quality"]
-        if (param in _obj and not _obj[param]) or (param not in _obj):
-            url = f"https://www.data.gouv.fr/fr/{object_type}/{k['slug']}/"
-            missing.append(
-                {
-                    "URL": url,
-                    "Titre": k["title"],
-                    "Organisation": k["organization"]["name"],
-                    "tag HVD": ", ".join(
-                        [categories[t] for t in k["tags"] if t in categories]
-                    ),
-                    "URL data.gouv": f"[{url}]({url})",
-                }
+    index = objects_index[object_type].get(wait=False)
+    if index is not None:
+        failing = index["failing"].get(param, [])
+        if not failing:
+            return [html.H6("Tous les objets HVD respectent ce critère")]
+        title = (
+            f"{len(failing)} objets HVD sur {index['total']} ne respectent pas "
+            f"ce critère, à améliorer (max {max_displayed_suggestions}) :"
+        )
+        # so that we don't always show the same ones
+        failing = reservoir_sample(failing, max_displayed_suggestions)
+    else:
+        # the index is being built in the background, meanwhile showing the first
+        # failing objects, which doesn't require scanning the whole catalog
+        failing = [
+            light_object(k)
+            for k in islice(
+                (
+                    k
+                    for k in get_all_from_api_query(
+                        **hvd_objects_query(object_type), ordered=False
+                    )
+                    if is_failing(k, param, object_type)
+                ),
+                max_displayed_suggestions,
             )
-    if not missing:
-        return [html.H6("Un problème est survenu lors de la récupération des données")]
-    missing = pd.DataFrame(missing)
-    merged = pd.merge(
-        missing,
-        df_ouverture,
-        on="URL",
-        how="left",
-    ).drop("URL", axis=1)
+        ]
+        if not failing:
+            return [
+                html.H6("Un problème est survenu lors de la récupération des données")
+            ]
+        title = f"A améliorer (max {max_displayed_suggestions}):"
+    reference = get_hvd_reference()
+    categories = reference["categories"]
+    missing = []
+    for k in failing:
+        url = f"https://www.data.gouv.fr/fr/{object_type}/{k['slug']}/"
+        missing.append(
+            {
+                "URL": url,
+                "Titre": k["title"],
+                "Organisation": k["organization"],
+                "tag HVD": ", ".join(
+                    [categories[t] for t in k["tags"] if t in categories]
+                ),
+                "URL data.gouv": f"[{url}]({url})",
+            }
+        )
+    by_url = reference["by_url"]
+    merged = pd.DataFrame(
+        [
+            {**m, **ouverture}
+            for m in missing
+            for ouverture in by_url.get(m["URL"], [{}])
+        ],
+        columns=[
+            "Titre",
+            "Organisation",
+            "tag HVD",
+            "URL data.gouv",
+            "Ensemble_de_donnees",
+            "Thematique",
+        ],
+    )
     columns = [
         {"name": ["data.gouv", "Titre"], "id": "titre"},
         {"name": ["data.gouv", "Organisation"], "id": "orga"},
@@ -350,7 +496,7 @@ def display_objects_to_improve(param, object_type, store):
         c.update({"type": "text", "presentation": "markdown"})
     merged.rename({c["name"][1]: c["id"] for c in columns}, axis=1, inplace=True)
     return [
-        html.H6(f"A améliorer (max {max_displayed_suggestions}):"),
+        html.H6(title),
         dash_table.DataTable(
             merged.to_dict("records"),
             columns,
@@ -375,59 +521,10 @@ def display_objects_to_improve(param, object_type, store):
     Output("hvd:resources_types", "figure"),
     [
         Input("hvd:slider", "value"),
+        Input("tabs", "value"),
     ],
+    [State("hvd:resources_types", "figure")],
 )
-def change_resources_types_graph(percent_threshold):
-    data = []
-    resources_stats = json.loads(get_file_content("resources_stats.json"))
-    dates = get_latest_day_of_each_month(resources_stats.keys())
-    for date in dates.values():
-        if resources_stats[date].get("hvd"):
-            for t in resources_stats[date]["hvd"]:
-                data.append([date, t, resources_stats[date]["hvd"][t]])
-    df = pd.DataFrame(data, columns=("date", "format", "count"))
-    df["date"] = df["date"].apply(first_day_same_month)
-    threshold = (
-        percent_threshold / 100 * df.loc[df["date"] == max(df["date"]), "count"].sum()
-    )
-    final = df.loc[df["count"] > threshold]
-    other = df.loc[df["count"] <= threshold]
-    for date in other["date"].unique():
-        final = pd.concat(
-            [
-                final,
-                pd.DataFrame(
-                    [
-                        [
-                            date,
-                            "Autres formats",
-                            other.loc[other["date"] == date, "count"].sum(),
-                        ]
-                    ],
-                    columns=final.columns,
-                ),
-            ]
-        )
-    final.sort_values(by="count", ascending=False, inplace=True)
-    y_max = max(
-        [
-            sum(final.loc[final["date"] == date, "count"])
-            for date in final["date"].unique()
-        ]
-    )
-    fig = px.bar(
-        final,
-        x="date",
-        y="count",
-        color="format",
-        text_auto=True,
-    )
-    fig.update_layout(
-        xaxis=dict(
-            title="Mois",
-            tickformat="%b 20%y",
-        ),
-        yaxis_title="Nombre de ressources par format de fichier",
-        yaxis_range=[0, y_max * 1.1],
-    )
-    return fig
+def change_resources_types_graph(percent_threshold, tab, figure):
+    only_in_selected_tab("hvd", tab, figure)
+    return resources_types_figure("hvd", percent_threshold)
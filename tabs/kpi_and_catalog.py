@@ -8,18 +8,25 @@ from dash.exceptions import PreventUpdate
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-import json
 
+from tabs import scheduler
 from tabs.utils import (
     DATASETS_QUALITY_METRICS,
-    get_file_content,
-    get_latest_day_of_each_month,
-    first_day_same_month,
+    files_version,
+    get_parsed_file,
+    memoize_figure,
+    only_in_selected_tab,
+    parse_monthly_stats,
+    parsed_artifacts,
+    resource_cache,
+    resources_types_figure,
+    revalidate_files,
 )
 
 
 tab_kpi_catalog = dcc.Tab(
     label="KPIs & catalogue",
+    value="kpi_catalog",
     children=[
         html.H5("KPIs de data.gouv"),
         dbc.Row(
@@ -124,18 +131,59 @@ tab_kpi_catalog = dcc.Tab(
 )
 
 
+kpis_url = "https://www.data.gouv.fr/fr/datasets/r/79e2c14d-8278-4407-84b5-e8c279fc578c"
+
+
+def parse_kpis(path):
+    kpis = pd.read_csv(
+        path,
+        usecols=["indicateur", "date", "valeur", "unite_mesure", "dataviz_wish"],
+        parse_dates=["date"],
+    )
+    indicators = kpis["indicateur"].unique()
+    kpis = kpis.sort_values("date", kind="stable")
+    kpis["mois"] = kpis["date"].dt.strftime("%Y-%m")
+    # first value of each month
+    kpis = kpis.drop_duplicates(subset=["indicateur", "mois"])
+    series = dict(iter(kpis.groupby("indicateur")))
+    return {indic: series[indic].reset_index(drop=True) for indic in indicators}
+
+
+@scheduler.job("kpis", every=3600)
+def load_kpis():
+    # (version of the KPIs file, {indicateur: its monthly series})
+    path, version = resource_cache.get(kpis_url)
+    return version, parsed_artifacts.get(kpis_url, version, lambda: parse_kpis(path))
+
+
+def get_kpis():
+    return scheduler.get("kpis")[1]
+
+
+@scheduler.job("catalog", every=600)
+def load_catalog_files():
+    # builds the default figures before anyone opens the tab
+    revalidate_files("datasets_quality.json", "resources_stats.json")
+    datasets_quality_figure("all", DATASETS_QUALITY_METRICS[0]["value"])
+    resources_types_figure("all", 2)
+
+
 # %% Callbacks
 @dash.callback(
     Output("kpi:datastore", "data"),
-    [Input("kpi:button_refresh", "n_clicks")],
+    [
+        Input("kpi:button_refresh", "n_clicks"),
+        Input("tabs", "value"),
+    ],
     [State("kpi:datastore", "data")],
 )
-def refresh_kpis(click, datastore):
-    kpis = pd.read_csv(
-        "https://www.data.gouv.fr/fr/datasets/r/79e2c14d-8278-4407-84b5-e8c279fc578c"
+def refresh_kpis(click, tab, datastore):
+    only_in_selected_tab("kpi_catalog", tab, datastore)
+    # the KPIs stay server-side, the store only holds their version
+    version, _ = scheduler.get(
+        "kpis", force=dash.ctx.triggered_id == "kpi:button_refresh"
     )
-    datastore.update({"kpis": kpis.to_json()})
-    return datastore
+    return {"version": version}
 
 
 @dash.callback(
@@ -146,28 +194,21 @@ def refresh_kpis(click, datastore):
     [Input("kpi:datastore", "data")],
 )
 def refresh_kpis_dropdown(datastore):
-    kpis = pd.read_json(datastore["kpis"])
-    options = [{"label": k, "value": k} for k in kpis["indicateur"].unique()]
+    if not datastore:
+        raise PreventUpdate
+    kpis = get_kpis()
+    options = [{"label": k, "value": k} for k in kpis]
     return options, options[0]["value"]
 
 
-@dash.callback(
-    Output("kpi:graph_kpi", "figure"),
-    [Input("kpi:dropdown", "value")],
-    [State("kpi:datastore", "data")],
-)
-def change_kpis_graph(indic, datastore):
-    if not indic:
-        raise PreventUpdate
+@memoize_figure(lambda: scheduler.get("kpis")[0])
+def kpi_figure(indic):
     mapping = {
         "barchart": px.bar,
         "linechart": px.line,
         "scatterplot": px.scatter,
     }
-    kpis = pd.read_json(datastore["kpis"])
-    restr = kpis.loc[kpis["indicateur"] == indic].sort_values("date")
-    restr["mois"] = restr["date"].apply(lambda d: d.strftime("%Y-%m"))
-    restr = restr.drop_duplicates(subset="mois")
+    restr = get_kpis()[indic]
     _method = mapping.get(restr["dataviz_wish"].unique()[0])
     fig = _method(
         restr,
@@ -188,31 +229,26 @@ def change_kpis_graph(indic, datastore):
 
 
 @dash.callback(
-    Output("catalog:datasets_types", "figure"),
-    [
-        Input("catalog:dropdown_datasets_types", "value"),
-        Input("catalog:dropdown_quality_indicator", "value"),
-    ],
+    Output("kpi:graph_kpi", "figure"),
+    [Input("kpi:dropdown", "value")],
+    [State("kpi:datastore", "data")],
 )
-def change_datasets_quality_graph(indic, param):
-    if not indic or not param:
+def change_kpis_graph(indic, datastore):
+    if not indic or not datastore:
         raise PreventUpdate
-    datasets_quality = json.loads(get_file_content("datasets_quality.json"))
-    dates = get_latest_day_of_each_month(datasets_quality.keys())
-    data = []
-    for date in dates.values():
-        data.append([date, datasets_quality[date][indic][param]])
-    df = pd.DataFrame(data, columns=("date", "moyenne"))
-    volumes = [
-        [first_day_same_month(d), datasets_quality[d]["count"][indic]]
-        for d in df["date"].unique()
-    ]
-    df["date"] = df["date"].apply(first_day_same_month)
+    return kpi_figure(indic)
+
+
+@memoize_figure(files_version("datasets_quality.json"))
+def datasets_quality_figure(indic, param):
+    datasets_quality = get_parsed_file("datasets_quality.json", parse_monthly_stats)
+    df = datasets_quality.loc[(indic, param)].rename("moyenne").reset_index()
+    volumes = datasets_quality.loc[("count", indic)].reindex(df["date"])
     fig = px.bar(df, x="date", y="moyenne", text_auto=True)
     fig.add_trace(
         go.Scatter(
-            x=[v[0] for v in volumes],
-            y=[v[1] for v in volumes],
+            x=volumes.index,
+            y=volumes.values,
             mode="lines",
             name="Nombre de jeux de données",
             yaxis="y2",
@@ -229,72 +265,40 @@ def change_datasets_quality_graph(indic, param):
             title="Nombre de jeux de données",
             overlaying="y",
             side="right",
-            range=[0, max([v[1] for v in volumes]) * 1.1],
+            range=[0, volumes.max() * 1.1],
         ),
         legend=dict(orientation="h", y=1.1, x=0),
     )
     return fig
 
 
+@dash.callback(
+    Output("catalog:datasets_types", "figure"),
+    [
+        Input("catalog:dropdown_datasets_types", "value"),
+        Input("catalog:dropdown_quality_indicator", "value"),
+        Input("tabs", "value"),
+    ],
+    [State("catalog:datasets_types", "figure")],
+)
+def change_datasets_quality_graph(indic, param, tab, figure):
+    if not indic or not param:
+        raise PreventUpdate
+    only_in_selected_tab("kpi_catalog", tab, figure)
+    return datasets_quality_figure(indic, param)
+
+
 @dash.callback(
     Output("catalog:resources_types", "figure"),
     [
         Input("catalog:dropdown_resources_types", "value"),
         Input("catalog:slider", "value"),
+        Input("tabs", "value"),
     ],
+    [State("catalog:resources_types", "figure")],
 )
-def change_resources_types_graph(indic, percent_threshold):
+def change_resources_types_graph(indic, percent_threshold, tab, figure):
     if not indic:
         raise PreventUpdate
-    data = []
-    resources_stats = json.loads(get_file_content("resources_stats.json"))
-    dates = get_latest_day_of_each_month(resources_stats.keys())
-    for date in dates.values():
-        for t in resources_stats[date][indic]:
-            data.append([date, t, resources_stats[date][indic][t]])
-    df = pd.DataFrame(data, columns=("date", "format", "count"))
-    df["date"] = df["date"].apply(first_day_same_month)
-    threshold = (
-        percent_threshold / 100 * df.loc[df["date"] == max(df["date"]), "count"].sum()
-    )
-    final = df.loc[df["count"] > threshold]
-    other = df.loc[df["count"] <= threshold]
-    for date in other["date"].unique():
-        final = pd.concat(
-            [
-                final,
-                pd.DataFrame(
-                    [
-                        [
-                            date,
-                            "Autres formats",
-                            other.loc[other["date"] == date, "count"].sum(),
-                        ]
-                    ],
-                    columns=final.columns,
-                ),
-            ]
-        )
-    final.sort_values(by="count", ascending=False, inplace=True)
-    y_max = max(
-        [
-            sum(final.loc[final["date"] == date, "count"])
-            for date in final["date"].unique()
-        ]
-    )
-    fig = px.bar(
-        final,
-        x="date",
-        y="count",
-        color="format",
-        text_auto=True,
-    )
-    fig.update_layout(
-        xaxis=dict(
-            title="Mois",
-            tickformat="%b 20%y",
-        ),
-        yaxis_title="Nombre de ressources par format de fichier",
-        yaxis_range=[0, y_max * 1.1],
-    )
-    return fig
+    only_in_selected_tab("kpi_catalog", tab, figure)
+    return resources_types_figure(indic, percent_threshold)
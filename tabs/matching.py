@@ -0,0 +1,79 @@
+from collections import Counter, defaultdict
+from functools import lru_cache
+import re
+
+import numpy as np
+from rapidfuzz import fuzz, process
+from unidecode import unidecode
+
+duplicate_slug_pattern = r"-\d+$"
+
+
+@lru_cache(maxsize=100_000)
+def clean(text):
+    if isinstance(text, str):
+        if re.search(duplicate_slug_pattern, text) is not None:
+            suffix = re.findall(duplicate_slug_pattern, text)[0]
+            text = text[: -len(suffix)]
+        return unidecode(text.lower()).replace("-", "")
+    else:
+        return ""
+
+
+def score_pairs(left, right):
+    """
+    Partial ratio of each (left[i], right[i]) pair of cleaned strings, as integers
+    like thefuzz's. Scored in one batched call, spread over all cores by rapidfuzz,
+    partial_ratio being symmetric (the shortest string is searched in the longest)
+    """
+    if not len(left):
+        return np.array([], dtype=int)
+    scores = process.cpdist(
+        [clean(s) for s in left],
+        [clean(s) for s in right],
+        scorer=fuzz.partial_ratio,
+        workers=-1,
+    )
+    return np.rint(scores).astype(int)
+
+
+class NgramIndex:
+    """
+    Inverted index of the character n-grams of names, to find the names close to
+    a query by only scoring the few that share the most n-grams with it
+    """
+
+    def __init__(self, names, n=3, max_candidates=20):
+        self.n = n
+        self.max_candidates = max_candidates
+        self.names = [clean(name) for name in names]
+        self.postings = defaultdict(list)
+        for idx, name in enumerate(self.names):
+            for gram in self.ngrams(name):
+                self.postings[gram].append(idx)
+        # n-grams found in too many names (like " de") don't discriminate anything
+        self.max_postings = max(len(self.names) // 20, 100)
+
+    def ngrams(self, text):
+        text = f" {text} "
+        return {text[i : i + self.n] for i in range(len(text) - self.n + 1)}
+
+    def search(self, query, min_score=0, limit=3):
+        # returns [(index of the name, score)], best matches first
+        query = clean(query)
+        shared = Counter()
+        for gram in self.ngrams(query):
+            postings = self.postings.get(gram, [])
+            if len(postings) <= self.max_postings:
+                shared.update(postings)
+        candidates = [idx for idx, _ in shared.most_common(self.max_candidates)]
+        return [
+            (candidates[position], round(score))
+            for _, score, position in process.extract(
+                query,
+                [self.names[idx] for idx in candidates],
+                scorer=fuzz.token_set_ratio,
+                score_cutoff=min_score,
+                limit=limit,
+            )
+        ]
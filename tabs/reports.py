@@ -1,16 +1,22 @@
 import dash
 from dash import dcc
 import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 from dash import html
 
 import pandas as pd
 import plotly.express as px
-from datetime import datetime
+from datetime import datetime, timedelta
+import threading
 
+from tabs import scheduler
+from tabs.cache import read_local_json, write_local_json
 from tabs.utils import (
     get_all_from_api_query,
     add_total_top_bar,
+    memoize_figure,
+    only_in_selected_tab,
 )
 
 reasons = {
@@ -29,8 +35,26 @@ subjects = {
     "Discussion": "Discussion",
 }
 
+reports_url = "https://www.data.gouv.fr/api/1/reports/"
+reports_mask = "data{id,reason,subject{class},reported_at,subject_deleted_at}"
+reports_file = "reports.json"
+# reports from this period before the latest one are fetched again on each refresh
+# to get their subject_deleted_at, older changes are caught by the daily full sync
+recheck_window = timedelta(days=30)
+full_sync_every = timedelta(days=1)
+
+# {"reports": {id: report}, "last_full_sync": iso date, "version": int}
+reports_store = read_local_json(
+    reports_file, {"reports": {}, "last_full_sync": None, "version": 0}
+)
+reports_lock = threading.Lock()
+# slices of the latest reports cube, computed once per version of the reports
+reports_slices = {"version": None, "slices": {}}
+reports_slices_lock = threading.Lock()
+
 tab_reports = dcc.Tab(
     label="Signalements",
+    value="reports",
     children=[
         dbc.Row(
             [
@@ -67,84 +91,185 @@ tab_reports = dcc.Tab(
                         ),
                     ]
                 ),
+                dbc.Col(
+                    [
+                        dbc.Button(
+                            id="reports:button_refresh",
+                            children="Rafraîchir les données",
+                        ),
+                    ]
+                ),
             ],
             style={"padding": "15px 0px 5px 0px"},
         ),
         html.Div(id="reports:graph"),
+        dcc.Store(id="reports:datastore", data={}),
     ],
 )
 
 
+def light_report(report):
+    return {
+        "reason": report["reason"],
+        "subject_class": report["subject"]["class"],
+        "reported_at": report["reported_at"],
+        "subject_deleted_at": report["subject_deleted_at"],
+    }
+
+
+def sync_reports():
+    with reports_lock:
+        # the reports may have been synced by another process since
+        reports_store.update(read_local_json(reports_file, {}))
+        now = datetime.now()
+        last_full_sync = reports_store["last_full_sync"]
+        if (
+            not reports_store["reports"]
+            or last_full_sync is None
+            or now - datetime.fromisoformat(last_full_sync) > full_sync_every
+        ):
+            # also drops the reports that don't exist anymore
+            reports = {
+                r["id"]: light_report(r)
+                for r in get_all_from_api_query(
+                    reports_url, mask=reports_mask, ordered=False
+                )
+            }
+            reports_store["last_full_sync"] = now.isoformat()
+        else:
+            reports = dict(reports_store["reports"])
+            cutoff = (
+                max(datetime.fromisoformat(r["reported_at"]) for r in reports.values())
+                - recheck_window
+            )
+            for r in get_all_from_api_query(
+                reports_url + "?sort=-reported_at",
+                mask=reports_mask,
+                max_workers=1,
+            ):
+                if datetime.fromisoformat(r["reported_at"]) < cutoff:
+                    break
+                reports[r["id"]] = light_report(r)
+        if reports != reports_store["reports"]:
+            # swapping the whole dict so that readers never see it being modified
+            reports_store["reports"] = reports
+            reports_store["version"] += 1
+        write_local_json(reports_file, reports_store)
+        return reports_store["version"]
+
+
+def build_reports_cube(reports):
+    # counts and deletion delays per (month, reason, subject_class)
+    df = pd.DataFrame(reports.values())
+    df["month"] = df["reported_at"].str[:8] + "01"
+    df["delay"] = [
+        (
+            (
+                datetime.fromisoformat(deleted_at) - datetime.fromisoformat(reported_at)
+            ).total_seconds()
+            if pd.notna(deleted_at)
+            else None
+        )
+        for reported_at, deleted_at in zip(df["reported_at"], df["subject_deleted_at"])
+    ]
+    return df.groupby(["month", "reason", "subject_class"]).agg(
+        count=("delay", "size"),
+        delay_sum=("delay", "sum"),
+        delay_count=("delay", "count"),
+    )
+
+
+def slice_reports_cube(cube, subject_class, reason):
+    if subject_class != "all":
+        cube = cube.loc[cube.index.get_level_values("subject_class") == subject_class]
+    if reason != "all":
+        cube = cube.loc[cube.index.get_level_values("reason") == reason]
+    if not len(cube):
+        return None, None
+    # same breakdowns as in the graph
+    by, column, labels = None, None, None
+    if reason == "all":
+        by, column, labels = "reason", "Motif", reasons
+    elif subject_class == "all":
+        by, column, labels = "subject_class", "Objet", subjects
+    volumes = (
+        cube.groupby(level=["month"] + ([by] if by else []))["count"]
+        .sum()
+        .reset_index()
+    )
+    if by:
+        volumes[by] = volumes[by].map(labels)
+    volumes = volumes.rename({"month": "Mois", "count": "Volume", by: column}, axis=1)
+    mean_delay = None
+    if cube["delay_count"].sum():
+        mean_delay = pd.Timedelta(
+            seconds=cube["delay_sum"].sum() / cube["delay_count"].sum()
+        )
+    return volumes, mean_delay
+
+
+@scheduler.job("reports", every=900)
+def build_reports():
+    # (version of the reports, their cube), only rebuilt when they have changed
+    version = sync_reports()
+    previous = scheduler.jobs["reports"].result
+    if previous is not None and previous[0] == version:
+        return previous
+    if not reports_store["reports"]:
+        return version, None
+    return version, build_reports_cube(reports_store["reports"])
+
+
+def get_reports_slice(subject_class, reason):
+    version, cube = scheduler.get("reports")
+    with reports_slices_lock:
+        if reports_slices["version"] != version:
+            reports_slices["version"] = version
+            reports_slices["slices"] = {}
+        if cube is None:
+            return None, None
+        if (subject_class, reason) not in reports_slices["slices"]:
+            reports_slices["slices"][(subject_class, reason)] = slice_reports_cube(
+                cube, subject_class, reason
+            )
+        return reports_slices["slices"][(subject_class, reason)]
+
+
 # %% Callbacks
 @dash.callback(
-    Output("reports:graph", "children"),
+    Output("reports:datastore", "data"),
     [
-        Input("reports:dropdown_subject_class", "value"),
-        Input("reports:dropdown_reason", "value"),
+        Input("reports:button_refresh", "n_clicks"),
+        Input("tabs", "value"),
     ],
+    [State("reports:datastore", "data")],
 )
-def refresh_reports_graph(subject_class, reason):
-    # works for now, maybe we'll need something
-    # smarter when there are more reports
-    reports = get_all_from_api_query("https://www.data.gouv.fr/api/1/reports/")
-    data = []
-    for r in reports:
-        if (subject_class == "all" or r["subject"]["class"] == subject_class) and (
-            reason == "all" or r["reason"] == reason
-        ):
-            data.append(
-                {
-                    "month": r["reported_at"][:8] + "01",
-                    "reason": r["reason"],
-                    "subject_class": r["subject"]["class"],
-                    "reported_at": r["reported_at"],
-                    "subject_deleted_at": r["subject_deleted_at"],
-                }
-            )
-    if not data:
-        return html.H5("Aucun signalement ne correspond à ces critères.")
+def refresh_reports(click, tab, datastore):
+    only_in_selected_tab("reports", tab, datastore)
+    version, _ = scheduler.get(
+        "reports", force=dash.ctx.triggered_id == "reports:button_refresh"
+    )
+    return {"version": version}
+
 
-    # graph
-    df = pd.DataFrame(data)[["month", "reason", "subject_class"]]
-    df["reason"] = df["reason"].apply(lambda x: reasons[x])
-    df["subject_class"] = df["subject_class"].apply(lambda x: subjects[x])
+@memoize_figure(lambda: scheduler.get("reports")[0])
+def reports_figure(subject_class, reason):
+    volumes, _ = get_reports_slice(subject_class, reason)
     color = None
     if reason != "all" and subject_class != "all":
-        volumes = (
-            df["month"]
-            .value_counts()
-            .reset_index()
-            .rename({"index": "Mois", "month": "Volume"}, axis=1)
-        )
         title = (
             f"Signalements par mois pour le motif `{reason}`"
             f" et les {subject_class.lower()}s"
         )
-
     elif reason == "all":
         color = "Motif"
-        volumes = (
-            df[["month", "reason"]]
-            .value_counts()
-            .reset_index()
-            .rename({"month": "Mois", "reason": color, "count": "Volume"}, axis=1)
-        )
         title = "Signalements par mois pour tous les motifs et "
         if subject_class == "all":
             title += "tous les objets"
         else:
             title += f"les {subject_class.lower()}s"
-
     else:
         color = "Objet"
-        volumes = (
-            df[["month", "subject_class"]]
-            .value_counts()
-            .reset_index()
-            .rename(
-                {"month": "Mois", "subject_class": color, "count": "Volume"}, axis=1
-            )
-        )
         title = f"Signalements par mois pour le motif `{reason}` et tous les objets"
 
     fig = px.bar(
@@ -162,21 +287,29 @@ def refresh_reports_graph(subject_class, reason):
             tickformat="%b 20%y",
         ),
     )
+    return fig
+
+
+@dash.callback(
+    Output("reports:graph", "children"),
+    [
+        Input("reports:dropdown_subject_class", "value"),
+        Input("reports:dropdown_reason", "value"),
+        Input("reports:datastore", "data"),
+    ],
+)
+def refresh_reports_graph(subject_class, reason, datastore):
+    if not datastore:
+        raise PreventUpdate
+    volumes, mean_delay = get_reports_slice(subject_class, reason)
+    if volumes is None:
+        return html.H5("Aucun signalement ne correspond à ces critères.")
 
     # average time to delete
-    delays = pd.DataFrame(data)[["reported_at", "subject_deleted_at"]]
-    delays = delays.loc[~(delays["subject_deleted_at"].isnull())]
     delay_div = html.Div()
-    if len(delays):
-        delays["delay"] = delays.apply(
-            lambda x: (
-                datetime.fromisoformat(x["subject_deleted_at"])
-                - datetime.fromisoformat(x["reported_at"])
-            ),
-            axis=1,
-        )
+    if mean_delay is not None:
         delay_div = html.H5(
             "Délai moyen avant suppression des objets en question : "
-            f"{str(delays['delay'].mean()).replace('days', 'jours').split('.')[0]}"
+            f"{str(mean_delay).replace('days', 'jours').split('.')[0]}"
         )
-    return [delay_div, dcc.Graph(figure=fig)]
+    return [delay_div, dcc.Graph(figure=reports_figure(subject_class, reason))]
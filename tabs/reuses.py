@@ -1,22 +1,25 @@
 import dash
 from dash import dcc
 import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from io import StringIO
 
+from tabs import scheduler
 from tabs.utils import (
     get_file_content,
     get_latest_day_of_each_month,
     add_total_top_bar,
+    only_in_selected_tab,
 )
 
 
 tab_reuses = dcc.Tab(
     label="Reuses",
+    value="reuses",
     children=[
         dbc.Row(
             [
@@ -31,13 +34,11 @@ tab_reuses = dcc.Tab(
 )
 
 
-# %% Callbacks
-@dash.callback(
-    Output("reuses:graph", "figure"),
-    [Input("reuses:button_refresh", "n_clicks")],
-)
-def refresh_reuses_graph(click):
-    hist = pd.read_csv(StringIO(get_file_content("stats_reuses_down.csv")))
+@scheduler.job("reuses", every=3600)
+def build_reuses_graph():
+    hist = pd.read_csv(
+        StringIO(get_file_content("stats_reuses_down.csv", revalidate=True))
+    )
     hist = hist.loc[
         hist["Date"].isin(get_latest_day_of_each_month(hist["Date"]).values())
     ]
@@ -85,3 +86,19 @@ def refresh_reuses_graph(click):
         legend=dict(orientation="h", y=1.1, x=0),
     )
     return fig
+
+
+# %% Callbacks
+@dash.callback(
+    Output("reuses:graph", "figure"),
+    [
+        Input("reuses:button_refresh", "n_clicks"),
+        Input("tabs", "value"),
+    ],
+    [State("reuses:graph", "figure")],
+)
+def refresh_reuses_graph(click, tab, figure):
+    only_in_selected_tab("reuses", tab, figure)
+    return scheduler.get(
+        "reuses", force=dash.ctx.triggered_id == "reuses:button_refresh"
+    )
@@ -0,0 +1,168 @@
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dash.exceptions import PreventUpdate
+
+from tabs.cache import cache_folder, write_atomically
+
+try:
+    import fcntl
+except ImportError:
+    # no lock across processes (e.g. on Windows), jobs are only deduplicated
+    # between the threads of each process
+    fcntl = None
+
+jobs_folder = os.path.join(cache_folder, "jobs")
+# how often the scheduler checks which jobs are due
+tick = 5
+# delay before retrying a failed job, doubled after each failure up to `every`
+retry_delay = 30
+
+
+class Job:
+    """
+    Function run every `every` seconds in the background, whose latest result
+    is served right away. Runs are deduplicated between threads with a lock,
+    and between processes with a file lock, the result of a run being stored
+    on disk for the other processes to load.
+    """
+
+    def __init__(self, name, run, every):
+        self.name = name
+        self.run = run
+        self.every = every
+        self.result = None
+        self.ran_at = 0
+        self.failed_at = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._path = os.path.join(jobs_folder, name)
+
+    def _load(self):
+        # loads the result stored by another run, if it is newer than ours
+        try:
+            with open(self._path + ".pickle", "rb") as f:
+                stored = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            # e.g. stored by a previous version of the code or of a library,
+            # the file is dropped and the job will run again
+            print(e)
+            try:
+                os.remove(self._path + ".pickle")
+            except OSError:
+                pass
+            return False
+        if stored["ran_at"] <= self.ran_at:
+            return False
+        self.result, self.ran_at = stored["result"], stored["ran_at"]
+        return True
+
+    def _run(self):
+        result = self.run()
+        ran_at = time.time()
+        try:
+            write_atomically(
+                self._path + ".pickle",
+                pickle.dumps({"ran_at": ran_at, "result": result}),
+            )
+        except (OSError, pickle.PicklingError) as e:
+            print(e)
+        self.result, self.ran_at = result, ran_at
+
+    def _run_in_process_lock(self, requested_at):
+        if fcntl is None:
+            self._run()
+            return
+        os.makedirs(jobs_folder, exist_ok=True)
+        with open(self._path + ".lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another process is running the job, we'll use its result
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._load()
+                if self.ran_at < requested_at:
+                    self._run()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def refresh(self, wait=True):
+        # a run that ended after the request is as good as a new one
+        requested_at = time.time()
+        if not self._lock.acquire(blocking=wait):
+            # already running
+            return
+        try:
+            if self.ran_at < requested_at:
+                self._run_in_process_lock(requested_at)
+            self.failures = 0
+        except Exception as e:
+            # we'll keep serving the last result
+            print(e)
+            self.failed_at = time.time()
+            self.failures += 1
+        finally:
+            self._lock.release()
+
+    def is_due(self):
+        now = time.time()
+        if self.failures:
+            backoff = min(self.every, retry_delay * 2 ** (self.failures - 1))
+            if now - self.failed_at < backoff:
+                return False
+        return now - self.ran_at > self.every
+
+    def get(self, force=False):
+        if force:
+            self.refresh()
+        elif not self.ran_at and not self._load() and self.is_due():
+            # not retrying on each access while a failed job is backing off
+            self.refresh()
+        return self.result
+
+
+jobs = {}
+
+
+def job(name, every):
+    # registers the decorated function as a job
+    def register(run):
+        jobs[name] = Job(name, run, every)
+        return run
+
+    return register
+
+
+def get(name, force=False):
+    # latest result of the job, run first if there's none yet or if `force`
+    job = jobs[name]
+    result = job.get(force=force)
+    if not job.ran_at:
+        # the job has never succeeded, callbacks have nothing to show
+        raise PreventUpdate
+    return result
+
+
+def run_pending(executor):
+    for job in jobs.values():
+        if job.is_due() and not job._load():
+            executor.submit(job.refresh, wait=False)
+
+
+def start(max_workers=3):
+    def loop():
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                try:
+                    run_pending(executor)
+                except Exception as e:
+                    print(e)
+                time.sleep(tick)
+
+    threading.Thread(target=loop, daemon=True).start()
@@ -5,26 +5,30 @@ import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 
+from itertools import islice
 import pandas as pd
-import requests
-import re
-from unidecode import unidecode
-from thefuzz import fuzz
-from time import sleep
+import threading
 
 from my_secrets import (
     DATAGOUV_API_KEY,
 )
+from tabs import enrichment, http_client
+from tabs.cache import PersistedResource, read_local_json, write_local_json
+from tabs.enrichment import search_company
+from tabs.matching import NgramIndex, score_pairs
 from tabs.utils import (
     max_displayed_suggestions,
     every_second_row_style,
+    enrich_concurrently,
+    get_all_from_api_query,
+    get_resource_file,
+    only_in_selected_tab,
+    parsed_artifacts,
 )
 
-duplicate_slug_pattern = r"-\d+$"
-entreprises_api_url = "https://recherche-entreprises.api.gouv.fr/search?q="
-
 tab_siret = dcc.Tab(
     label="SIRETisation (IRVE)",
+    value="siret",
     children=[
         dbc.Row(
             children=[
@@ -68,126 +72,288 @@ tab_siret = dcc.Tab(
             style={"padding": "15px 0px 5px 0px"},
         ),
         html.Div(id="siret:matches"),
+        dcc.Store(id="siret:cursor"),
     ],
 )
 
 
-def clean(text):
-    if isinstance(text, str):
-        if re.search(duplicate_slug_pattern, text) is not None:
-            suffix = re.findall(duplicate_slug_pattern, text)[0]
-            text = text[: -len(suffix)]
-        return unidecode(text.lower()).replace("-", "")
-    else:
-        # print(text)
-        return ""
+irve_url = "https://www.data.gouv.fr/fr/datasets/r/eb76d20a-8501-400e-b336-d85724de5435"
+irve_columns = ["datagouv_organization_or_owner", "nom_amenageur", "siren_amenageur"]
+# organizations we know have a SIRET, because we checked or SIRETised them
+siretised_file = "siretised.json"
+siretised = set(read_local_json(siretised_file, []))
+siretised_lock = threading.Lock()
+
+
+def build_candidate_table():
+    # {hash of an IRVE row: [organization, operator, siren, ratio]}
+    # only the rows that were not in the previous table are scored
+    previous = candidate_table.value or {}
+    df = pd.read_csv(get_resource_file(irve_url), dtype=str, usecols=irve_columns)
+    restr = df.loc[
+        (~df["siren_amenageur"].isna()) & (~df["nom_amenageur"].isna()),
+        irve_columns,
+    ].drop_duplicates()
+    restr = restr.astype(object).where(restr.notna(), None)
+    hashes = pd.util.hash_pandas_object(restr, index=False).astype(str)
+    new = restr.loc[~hashes.isin(previous)]
+    ratios = dict(
+        zip(
+            hashes.loc[new.index],
+            score_pairs(
+                new["datagouv_organization_or_owner"].to_list(),
+                new["nom_amenageur"].to_list(),
+            ),
+        )
+    )
+    return {
+        row_hash: (
+            previous[row_hash]
+            if row_hash in previous
+            else [*row, int(ratios[row_hash])]
+        )
+        for row_hash, row in zip(hashes, restr.itertuples(index=False, name=None))
+    }
+
+
+candidate_table = PersistedResource(
+    "siret_candidates.json", build_candidate_table, ttl=6 * 3600
+)
 
 
-def symetric_ratio(s1, s2):
-    _score = fuzz.partial_ratio
-    if len(s1) > len(s2):
-        return _score(s2, s1)
-    return _score(s1, s2)
+def remember_siretised(slug):
+    with siretised_lock:
+        siretised.add(slug)
+        write_local_json(siretised_file, sorted(siretised))
 
 
 def get_siret_from_siren(siren):
     try:
-        r = requests.get(entreprises_api_url + siren)
+        status, company = search_company(siren)
     except Exception:
-        sleep(1)
-        try:
-            r = requests.get(entreprises_api_url + siren)
-        except Exception:
-            return None
-    if not r.ok:
         return None
-    r = r.json()["results"]
-    if len(r) == 0:
+    if status == "not_found":
         print("No result")
         return None
-    if len(r) > 1:
-        print("Ambiguous :", len(r))
+    if status == "ambiguous":
+        print("Ambiguous :", company)
         return None
     else:
-        return r[0]["siege"]["siret"]
+        return company["siret"]
+
+
+def build_organizations():
+    return [
+        {
+            "slug": o["slug"],
+            "name": o["name"],
+            "business_number_id": o["business_number_id"],
+        }
+        for o in get_all_from_api_query(
+            "https://www.data.gouv.fr/api/1/organizations/?page_size=100",
+            mask="data{name,slug,business_number_id}",
+            ordered=False,
+        )
+    ]
+
+
+organizations = PersistedResource(
+    "organizations.json", build_organizations, ttl=24 * 3600
+)
+# (built_at, organizations, index of their names), swapped at once
+organizations_index = {"current": (None, [], None)}
+
+
+def get_organizations_index():
+    orgas, built_at = organizations.get(), organizations.built_at
+    if orgas is not None and organizations_index["current"][0] != built_at:
+        organizations_index["current"] = (
+            built_at,
+            orgas,
+            NgramIndex([o["name"] for o in orgas]),
+        )
+    return organizations_index["current"][1:]
+
+
+def match_with_all_organizations(restr, min_score):
+    # IRVE operators (with a single SIREN) matched with the names of all
+    # data.gouv organizations that don't have a SIRET yet
+    orgas, index = get_organizations_index()
+    if index is None:
+        return
+    operators = restr.groupby("nom_amenageur")["siren_amenageur"].unique()
+    for match, sirens in operators.items():
+        if len(sirens) != 1:
+            continue
+        for position, _ in index.search(match, min_score=min_score, limit=1):
+            if not orgas[position]["business_number_id"]:
+                yield orgas[position]["slug"], orgas[position]["name"], match, sirens[0]
+
+
+def list_candidates(table, min_score):
+    # (slug, name, match, siren) of the organizations declared in the IRVE file
+    # with a single SIREN, whose name is fetched later (None here), then of the
+    # operators matched with any other organization
+    orgas, _ = get_organizations_index()
+    has_siret = {o["slug"] for o in orgas if o["business_number_id"]}
+    declared = (
+        table.loc[table["ratio"] > min_score]
+        .groupby("datagouv_organization_or_owner", sort=False)
+        .agg(
+            sirens=("siren_amenageur", "nunique"),
+            match=("nom_amenageur", "first"),
+            siren=("siren_amenageur", "first"),
+        )
+    )
+    declared = declared.loc[
+        (declared["sirens"] == 1) & (~declared.index.isin(has_siret))
+    ]
+    candidates = [
+        (slug, None, match, siren)
+        for slug, match, siren in zip(
+            declared.index, declared["match"], declared["siren"]
+        )
+    ]
+    seen = set(declared.index)
+    for slug, name, match, siren in match_with_all_organizations(table, min_score):
+        if slug not in seen:
+            seen.add(slug)
+            candidates.append((slug, name, match, siren))
+    return candidates
+
+
+def enrich_candidate(candidate):
+    position, (slug, name, match, siren) = candidate
+    siret = get_siret_from_siren(siren)
+    if not siret:
+        return None
+    if name is None:
+        r = http_client.get(
+            f"https://www.data.gouv.fr/api/1/organizations/{slug}/",
+            headers={"X-fields": "name,business_number_id"},
+        ).json()
+        if r["business_number_id"]:
+            # print(slug, 'already has siret:', r['business_number_id'])
+            remember_siretised(slug)
+            return None
+        name = r["name"]
+    return position, (slug, name, match, siren, siret)
+
+
+def siret_row(idx, slug, name, match, siren, siret):
+    md1 = (
+        f"[{name}](https://www.data.gouv.fr/fr/organizations/{slug}/) "
+        f"matchée avec {match}"
+    )
+    md2 = f"\nSIREN : {siren}, SIRET : {siret}"
+    return dbc.Row(
+        children=[
+            dbc.Col(children=[dcc.Markdown(md1), dcc.Markdown(md2)]),
+            dbc.Col(
+                children=[
+                    html.Div(
+                        dbc.Button(
+                            id={
+                                "type": "siret",
+                                "index": f"siret:button_{idx}_{slug}_{siret}",
+                            },
+                            children="SIRETiser cette organisation",
+                            color="info",
+                        ),
+                        style={"padding": "10px 0px 0px 0px"},
+                    )
+                ]
+            ),
+        ],
+        style=every_second_row_style(idx),
+    )
 
 
 # %% Callbacks
 @dash.callback(
-    Output("siret:matches", "children"),
-    [Input("siret:button_refresh", "n_clicks")],
-    [State("siret:slider", "value")],
+    [
+        Output("siret:matches", "children"),
+        Output("siret:cursor", "data"),
+    ],
+    [
+        Input("siret:button_refresh", "n_clicks"),
+        Input("siret:slider", "value"),
+        Input("tabs", "value"),
+    ],
+    [
+        State("siret:cursor", "data"),
+        State("siret:matches", "children"),
+    ],
 )
-def refresh_siret(click, slider):
-    df = pd.read_csv(
-        "https://www.data.gouv.fr/fr/datasets/r/eb76d20a-8501-400e-b336-d85724de5435",
-        dtype=str,
-        usecols=[
-            "nom_amenageur",
-            "siren_amenageur",
-            "datagouv_organization_or_owner",
-        ],
+def refresh_siret(click, slider, tab, cursor, matches):
+    only_in_selected_tab("siret", tab, matches)
+    table = candidate_table.get()
+    if table is None:
+        raise PreventUpdate
+    version = [candidate_table.built_at, organizations.built_at]
+    table = parsed_artifacts.get(
+        "siret:table",
+        candidate_table.built_at,
+        lambda: pd.DataFrame(list(table.values()), columns=irve_columns + ["ratio"]),
     )
-    restr = df.loc[
-        (~df["siren_amenageur"].isna()) & (~df["nom_amenageur"].isna())
-    ].drop_duplicates()
-    restr["cleaned_nom"] = restr["nom_amenageur"].apply(clean)
-    restr["cleaned_orga"] = restr["datagouv_organization_or_owner"].apply(clean)
-    restr["ratio"] = restr.apply(
-        lambda df_: symetric_ratio(df_["cleaned_orga"], df_["cleaned_nom"]), axis=1
+    candidates = parsed_artifacts.get(
+        ("siret:candidates", slider),
+        tuple(version),
+        lambda: list_candidates(table, slider),
+    )
+    # refreshing shows the next candidates, moving the slider starts over
+    # the cursor is the first candidate that hasn't been checked yet,
+    # along with the ones after it that have already been checked
+    start, checked = 0, []
+    if (
+        dash.ctx.triggered_id == "siret:button_refresh"
+        and cursor
+        and cursor["version"] == version
+        and cursor["slider"] == slider
+    ):
+        start, checked = cursor["position"], cursor["checked"]
+    checked = set(checked)
+
+    def enrich(candidate):
+        result = enrich_candidate(candidate)
+        if result is None:
+            checked.add(candidate[0])
+        return result
+
+    # for performance purposes, only displaying X suggestions
+    rate_limits_before = http_client.rate_limit_stats()
+    suggestions = sorted(
+        enrich_concurrently(
+            (
+                (position, candidate)
+                for position, candidate in islice(enumerate(candidates), start, None)
+                if position not in checked and candidate[0] not in siretised
+            ),
+            enrich,
+            max_displayed_suggestions,
+        )
+    )
+    enrichment.flush()
+    http_client.print_rate_limit_waits(rate_limits_before, "SIRET refresh")
+    checked.update(position for position, _ in suggestions)
+    if len(suggestions) < max_displayed_suggestions:
+        # all candidates have been seen, we start over
+        start, checked = 0, set()
+    while start in checked:
+        checked.remove(start)
+        start += 1
+    return (
+        [
+            siret_row(idx, *suggestion)
+            for idx, (_, suggestion) in enumerate(suggestions)
+        ],
+        {
+            "version": version,
+            "slider": slider,
+            "position": start,
+            "checked": sorted(checked),
+        },
     )
-    restr = restr.loc[restr["ratio"] > slider]
-    siret_divs = []
-    session = requests.Session()
-    for orga in restr["datagouv_organization_or_owner"].unique():
-        if len(siret_divs) == max_displayed_suggestions:
-            break
-        tmp = restr.loc[
-            restr["datagouv_organization_or_owner"] == orga
-        ].drop_duplicates("siren_amenageur")
-        if len(tmp) == 1:
-            siren = list(tmp["siren_amenageur"])[0]
-            siret = get_siret_from_siren(siren)
-            if not siret:
-                continue
-            slug = list(tmp["datagouv_organization_or_owner"])[0]
-            r = session.get(
-                f"https://www.data.gouv.fr/api/1/organizations/{slug}/",
-                headers={"X-fields": "name,business_number_id"},
-            ).json()
-            if r["business_number_id"]:
-                # print(orga, 'already has siret:', r['business_number_id'])
-                continue
-            match = list(tmp["nom_amenageur"])[0]
-            md1 = (
-                f"[{r['name']}](https://www.data.gouv.fr/fr/{slug}/) "
-                f"matchée avec {match}"
-            )
-            md2 = f"\nSIREN : {siren}, SIRET : {siret}"
-            siret_divs += [
-                dbc.Row(
-                    children=[
-                        dbc.Col(children=[dcc.Markdown(md1), dcc.Markdown(md2)]),
-                        dbc.Col(
-                            children=[
-                                html.Div(
-                                    dbc.Button(
-                                        id={
-                                            "type": "siret",
-                                            "index": f"siret:button_{len(siret_divs)}_{slug}_{siret}",
-                                        },
-                                        children="SIRETiser cette organisation",
-                                        color="info",
-                                    ),
-                                    style={"padding": "10px 0px 0px 0px"},
-                                )
-                            ]
-                        ),
-                    ],
-                    style=every_second_row_style(len(siret_divs)),
-                )
-            ]
-    return siret_divs
 
 
 @dash.callback(
@@ -208,7 +374,7 @@ def update_after_siret(*args):
     #     f"https://www.data.gouv.fr/api/1/organizations/{slug}/",
     #     headers={'X-fields': 'name'},
     # )
-    r = requests.put(
+    r = http_client.put(
         f"https://www.data.gouv.fr/api/1/organizations/{slug}/",
         json={"business_number_id": siret},
         headers={"X-API-KEY": DATAGOUV_API_KEY},
@@ -226,6 +392,7 @@ def update_after_siret(*args):
         )
         return patched_children
 
+    remember_siretised(slug)
     r = r.json()
     patched_children[idx] = dbc.Row(
         children=[
@@ -2,22 +2,25 @@ import dash
 from dash import dcc
 from dash import html
 import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 
 import pandas as pd
 from io import StringIO
 import plotly.express as px
 import plotly.graph_objects as go
 
+from tabs import scheduler
 from tabs.utils import (
     get_file_content,
     add_total_top_bar,
+    only_in_selected_tab,
 )
 
 support_file = "stats_support.csv"
 
 tab_support = dcc.Tab(
     label="Support",
+    value="support",
     children=[
         dbc.Row(
             [
@@ -131,17 +134,31 @@ def create_taux_graph(stats):
     return fig
 
 
+@scheduler.job("support", every=3600)
+def build_support_graphs():
+    stats = pd.read_csv(
+        StringIO(get_file_content(support_file, revalidate=True)), index_col=0
+    )
+    return create_volumes_graph(stats), create_taux_graph(stats)
+
+
 # %% Callbacks
 @dash.callback(
     [
         Output("support:graph_volumes", "figure"),
         Output("support:graph_taux", "figure"),
     ],
-    [Input("support:button_refresh", "n_clicks")],
+    [
+        Input("support:button_refresh", "n_clicks"),
+        Input("tabs", "value"),
+    ],
+    [State("support:graph_volumes", "figure")],
 )
-def update_graphs(click):
-    stats = pd.read_csv(StringIO(get_file_content(support_file)), index_col=0)
-    return create_volumes_graph(stats), create_taux_graph(stats)
+def update_graphs(click, tab, figure):
+    only_in_selected_tab("support", tab, figure)
+    return scheduler.get(
+        "support", force=dash.ctx.triggered_id == "support:button_refresh"
+    )
 
 
 @dash.callback(
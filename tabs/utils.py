@@ -1,6 +1,27 @@
+import dash
+from dash.exceptions import PreventUpdate
 from minio import Minio
-import requests
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import wraps
+import heapq
+from itertools import islice
+import json
+from math import ceil
+import random
+import pandas as pd
+import plotly.express as px
+from plotly.utils import PlotlyJSONEncoder
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 from my_secrets import DATAGOUV_API_KEY
+from tabs import http_client
+from tabs.cache import (
+    LRUCache,
+    ObjectStorageCache,
+    ParsedArtifacts,
+    ResourceFileCache,
+    SingleFlight,
+)
 
 bucket = "dataeng-open"
 folder = "dashboard/"
@@ -10,6 +31,13 @@ client = Minio(
     "object.files.data.gouv.fr",
     secure=True,
 )
+object_cache = ObjectStorageCache()
+resource_cache = ResourceFileCache()
+parsed_artifacts = ParsedArtifacts()
+# concurrent reads of the same object that bypass the cache share one call
+uncached_reads = SingleFlight()
+# JSON of the figures, shared by all users
+figures_cache = LRUCache(max_bytes=50 * 1024**2)
 
 
 def get_file_content(
@@ -18,9 +46,50 @@ def get_file_content(
     bucket=bucket,
     folder=folder,
     encoding="utf-8",
+    cache=True,
+    revalidate=False,
+):
+    if not cache:
+
+        def read():
+            r = client.get_object(bucket, folder + file_path)
+            try:
+                return r.read().decode(encoding)
+            finally:
+                r.close()
+                r.release_conn()
+
+        return uncached_reads.do((bucket, folder + file_path, encoding), read)
+    content, _ = object_cache.get(
+        client, bucket, folder + file_path, revalidate=revalidate
+    )
+    return content.decode(encoding)
+
+
+def get_resource_file(url):
+    # local copy of a resource, only downloaded again when it has changed
+    path, _ = resource_cache.get(url)
+    return path
+
+
+def get_parsed_file(
+    file_path,
+    parser,
+    client=client,
+    bucket=bucket,
+    folder=folder,
+    encoding="utf-8",
+    revalidate=False,
 ):
-    r = client.get_object(bucket, folder + file_path)
-    return r.read().decode(encoding)
+    # parsed once per (file, ETag), and shared between callbacks: don't modify it
+    content, etag = object_cache.get(
+        client, bucket, folder + file_path, revalidate=revalidate
+    )
+    return parsed_artifacts.get(
+        (bucket, folder + file_path, parser),
+        etag,
+        lambda: parser(content.decode(encoding)),
+    )
 
 
 def get_latest_day_of_each_month(days_list):
@@ -34,6 +103,130 @@ def get_latest_day_of_each_month(days_list):
     return last_days
 
 
+def parse_monthly_stats(content):
+    """
+    Turn a {date: {scope: {metric: value}}} JSON file into a tidy Series
+    indexed by (scope, metric, month), keeping the last day of each month
+    """
+    stats = json.loads(content)
+    dates = get_latest_day_of_each_month(stats.keys())
+    rows = [
+        (scope, metric, first_day_same_month(date), value)
+        for date in dates.values()
+        for scope, metrics in stats[date].items()
+        if isinstance(metrics, dict)
+        for metric, value in metrics.items()
+    ]
+    del stats
+    return (
+        pd.DataFrame(rows, columns=("scope", "metric", "date", "value"))
+        .set_index(["scope", "metric", "date"])["value"]
+        .sort_index()
+    )
+
+
+def group_other_formats(stats, percent_threshold):
+    """
+    Turn a (format, date) Series of resources counts into a (date, format, count)
+    DataFrame where the formats below `percent_threshold`% of the resources of
+    the latest month are summed as "Autres formats", and the highest total per date
+    """
+    df = stats.rename("count").reset_index().rename({"metric": "format"}, axis=1)
+    totals = df.groupby("date")["count"].sum()
+    threshold = percent_threshold / 100 * totals[totals.index.max()]
+    df["format"] = df["format"].where(df["count"] > threshold, "Autres formats")
+    final = (
+        df.groupby(["date", "format"], as_index=False, sort=False)["count"]
+        .sum()
+        .sort_values(by="count", ascending=False)
+    )
+    return final[["date", "format", "count"]], totals.max()
+
+
+def get_resources_types(scope, percent_threshold):
+    # computed once per (scope, threshold, version of the stats file)
+    _, etag = object_cache.get(client, bucket, folder + "resources_stats.json")
+    return parsed_artifacts.get(
+        ("resources_types", scope, percent_threshold),
+        etag,
+        lambda: group_other_formats(
+            get_parsed_file("resources_stats.json", parse_monthly_stats).loc[scope],
+            percent_threshold,
+        ),
+    )
+
+
+def revalidate_files(*file_paths):
+    # makes sure the next reads of these files are up to date, for background jobs
+    for file_path in file_paths:
+        object_cache.get(client, bucket, folder + file_path, revalidate=True)
+
+
+def files_version(*file_paths):
+    # version of object storage files, to be used with memoize_figure
+    def version():
+        return tuple(
+            object_cache.get(client, bucket, folder + file_path)[1]
+            for file_path in file_paths
+        )
+
+    return version
+
+
+def memoize_figure(version):
+    """
+    Caches the JSON of what the decorated function returns (figures...) per
+    arguments and `version()` of the data it is built from, so that identical
+    requests skip both pandas and plotly
+    """
+
+    def decorator(build):
+        @wraps(build)
+        def memoized(*args):
+            key = (build.__module__, build.__name__, json.dumps(args), version())
+            serialized = figures_cache.get(key)
+            if serialized is None:
+                serialized = json.dumps(build(*args), cls=PlotlyJSONEncoder)
+                figures_cache.set(key, serialized)
+            return json.loads(serialized)
+
+        return memoized
+
+    return decorator
+
+
+@memoize_figure(files_version("resources_stats.json"))
+def resources_types_figure(scope, percent_threshold):
+    final, y_max = get_resources_types(scope, percent_threshold)
+    fig = px.bar(
+        final,
+        x="date",
+        y="count",
+        color="format",
+        text_auto=True,
+    )
+    fig.update_layout(
+        xaxis=dict(
+            title="Mois",
+            tickformat="%b 20%y",
+        ),
+        yaxis_title="Nombre de ressources par format de fichier",
+        yaxis_range=[0, y_max * 1.1],
+    )
+    return fig
+
+
+def only_in_selected_tab(tab, selected_tab, *outputs):
+    """
+    Lets the callbacks loading a tab's content run only once the tab is selected,
+    and not again when coming back to it (its current `outputs` are passed as States)
+    """
+    if selected_tab != tab:
+        raise PreventUpdate
+    if dash.ctx.triggered_id == "tabs" and all(outputs):
+        raise PreventUpdate
+
+
 def every_second_row_style(idx):
     return {"background-color": "lightgray" if idx % 2 == 0 else "white"}
 
@@ -42,11 +235,23 @@ def first_day_same_month(date):
     return date[:7] + "-01"
 
 
+def set_pagination(url, page, page_size):
+    parts = urlsplit(url)
+    params = [
+        (k, v)
+        for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in ("page", "page_size")
+    ] + [("page", page), ("page_size", page_size)]
+    return urlunsplit(parts._replace(query=urlencode(params)))
+
+
 def get_all_from_api_query(
     base_query,
     next_page="next_page",
     ignore_errors=False,
     mask=None,
+    ordered=True,
+    max_workers=5,
 ):
     def get_link_next_page(elem, separated_keys):
         result = elem
@@ -54,33 +259,123 @@ def get_all_from_api_query(
             result = result[k]
         return result
 
+    def get_page(url):
+        r = http_client.get(url, headers=headers, timeout=5)
+        if not ignore_errors:
+            r.raise_for_status()
+        return r.json()
+
     # will need this to access reports endpoint
     headers = {"X-API-KEY": DATAGOUV_API_KEY}
     if mask is not None:
-        headers["X-fields"] = mask + f",{next_page}"
-    while True:
-        try:
-            r = requests.get(base_query, headers=headers, timeout=5)
-            break
-        except Exception as e:
-            print(e)
-    if not ignore_errors:
-        r.raise_for_status()
-    for elem in r.json()["data"]:
+        headers["X-fields"] = mask + f",{next_page},page,page_size,total"
+    r = get_page(base_query)
+    for elem in r["data"]:
         yield elem
-    while get_link_next_page(r.json(), next_page):
+    if not r.get("total") or not r.get("page_size"):
+        # no way to know how many pages there are, following links one by one
+        while get_link_next_page(r, next_page):
+            r = get_page(get_link_next_page(r, next_page))
+            for data in r["data"]:
+                yield data
+        return
+
+    # otherwise fetching the remaining pages concurrently, with a bounded
+    # number of pages in flight so that a slow consumer doesn't pile them up
+    urls = iter(
+        [
+            set_pagination(base_query, page, r["page_size"])
+            for page in range(
+                r.get("page", 1) + 1, ceil(r["total"] / r["page_size"]) + 1
+            )
+        ]
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(
+            executor.submit(get_page, url) for url in islice(urls, 2 * max_workers)
+        )
+        try:
+            while pending:
+                if ordered:
+                    future = pending.popleft()
+                else:
+                    future = next(iter(wait(pending, return_when=FIRST_COMPLETED)[0]))
+                    pending.remove(future)
+                for url in islice(urls, 1):
+                    pending.append(executor.submit(get_page, url))
+                for data in future.result()["data"]:
+                    yield data
+        finally:
+            # in case the consumer stops early
+            for future in pending:
+                future.cancel()
+
+
+def reservoir_sample(iterable, k, weight=None, seed=None):
+    """
+    k random items of iterable, in O(k) memory (without turning it into a list).
+    If weight is specified, items are drawn with probabilities proportional
+    to weight(item), otherwise uniformly
+    """
+    rng = random.Random(seed)
+    if weight is None:
+        sample = []
+        for idx, item in enumerate(iterable):
+            if idx < k:
+                sample.append(item)
+            else:
+                position = rng.randint(0, idx)
+                if position < k:
+                    sample[position] = item
+        return sample
+    # keeping the k items with the highest random() ** (1 / weight)
+    heap = []
+    for idx, item in enumerate(iterable):
+        w = weight(item)
+        if w <= 0:
+            continue
+        key = rng.random() ** (1 / w)
+        if len(heap) < k:
+            heapq.heappush(heap, (key, idx, item))
+        elif key > heap[0][0]:
+            heapq.heapreplace(heap, (key, idx, item))
+    return [item for _, _, item in heap]
+
+
+def enrich_concurrently(
+    candidates,
+    enrich,
+    max_results,
+    max_workers=10,
+    oversampling=2,
+):
+    # enriches candidates in parallel, with `oversampling` times more candidates
+    # in flight than the results we still need, and stops as soon as we have
+    # `max_results` valid results (those for which `enrich` doesn't return None)
+    results = []
+    candidates = iter(candidates)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = set()
+    try:
         while True:
-            try:
-                r = requests.get(
-                    get_link_next_page(r.json(), next_page), headers=headers, timeout=5
-                )
+            to_submit = oversampling * (max_results - len(results)) - len(pending)
+            for candidate in islice(candidates, max(to_submit, 0)):
+                pending.add(executor.submit(enrich, candidate))
+            if not pending or len(results) == max_results:
                 break
-            except Exception as e:
-                print(e)
-        if not ignore_errors:
-            r.raise_for_status()
-        for data in r.json()["data"]:
-            yield data
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(e)
+                    continue
+                if result is not None and len(results) < max_results:
+                    results.append(result)
+    finally:
+        # not waiting for the enrichments still in flight, their results are dropped
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
 
 
 def add_total_top_bar(fig, df, x, y):